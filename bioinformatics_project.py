@@ -18,8 +18,27 @@ import numpy as np
 import time
 import os
 import random
+import json
+import hashlib
+import tempfile
+import shutil
+import collections
+import threading
+import queue
+import resource
+import argparse
+import csv
+import subprocess
+import concurrent.futures
+import contextlib
+import http.server
+import urllib.request
 
 import PIL as pil
+import cv2
+import joblib
+from joblib.externals.loky import ProcessPoolExecutor
+import scipy.linalg
 
 from sklearn.linear_model import LinearRegression
 from sklearn.utils.class_weight import compute_sample_weight
@@ -30,164 +49,22 @@ from sklearn.model_selection import StratifiedKFold
 from IPython import display
 from google.colab import drive
 drive.mount('/content/gdrive')
+
+# The library code (retinopathy_gan.py, build_dataset.py) is imported from a clone of this repository
+!test -d /content/Diabetic-Retinopathy-Scoring-Using-GANs || git clone -q https://github.com/koudounasalkis/Diabetic-Retinopathy-Scoring-Using-GANs /content/Diabetic-Retinopathy-Scoring-Using-GANs
+import sys
+sys.path.append('/content/Diabetic-Retinopathy-Scoring-Using-GANs')
+from build_dataset import btgraham_preprocess, build_image_shards, verify_image_shards
 gan1, gan2 = None, None
 
 """## Utils"""
 
-class GAN(tf.keras.Model):
-    def __init__(self, discriminator, generator, latent_dim):
-        super(GAN, self).__init__()
-        self.latent_dim = latent_dim
-        self.discriminator = discriminator
-        self.generator = generator
-
-    def compile(self, d_optimizer, g_optimizer, loss_fn):
-        super(GAN, self).compile()
-        self.loss_fn = loss_fn
-        self.discriminator_optimizer = d_optimizer
-        self.generator_optimizer = g_optimizer
-
-    def train_step(self, images):
-        noise = tf.random.normal([batch_size, latent_dim])
-
-        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
-          generated_images = self.generator(noise, training=True)
-
-          real_output = self.discriminator(images, training=True)
-          fake_output = self.discriminator(generated_images, training=True)
-
-          gen_loss = self.loss_fn(tf.ones_like(fake_output), fake_output)
-
-          real_loss = self.loss_fn(tf.ones_like(real_output), real_output)
-          fake_loss = self.loss_fn(tf.zeros_like(fake_output), fake_output)
-          disc_loss = real_loss + fake_loss
-
-        gradients_of_generator = gen_tape.gradient(gen_loss, self.generator.trainable_variables)
-        gradients_of_discriminator = disc_tape.gradient(disc_loss, self.discriminator.trainable_variables)
-
-        self.generator_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
-        self.discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
-        return {"d_loss": disc_loss, "g_loss": gen_loss}
-
-def restore_gan(ver):
-  if ver == 1:
-    early_stride = (1,1)
-    late_stride = (2,2)
-    ckpts_path = '/content/gdrive/My Drive/normal_gan_ckpts'
-    lr = 0.0001
-  elif ver == 2:
-    early_stride = (2,2)
-    late_stride = (1,1)
-    ckpts_path = '/content/gdrive/My Drive/deep_aug_dims_ckpts'
-    lr = 0.00001
-  else:
-    print("Wrong version index")
-    return
-
-  discriminator = tf.keras.Sequential(
-      [
-          tf.keras.layers.InputLayer((512, 512, 3)),
-
-          tf.keras.layers.Conv2D(32, (4, 4), strides=(2, 2), padding='same'),
-          tf.keras.layers.LeakyReLU(),
-          tf.keras.layers.Dropout(0.3),
-
-          tf.keras.layers.Conv2D(64, (4, 4), strides=(2, 2), padding='same'),
-          tf.keras.layers.LeakyReLU(),
-          tf.keras.layers.Dropout(0.3),
-      
-          tf.keras.layers.Conv2D(128, (4, 4), strides=(2, 2), padding='same'),
-          tf.keras.layers.LeakyReLU(),
-          tf.keras.layers.Dropout(0.3),
-      
-          tf.keras.layers.Conv2D(256, (4, 4), strides=(2, 2), padding='same'),
-          tf.keras.layers.LeakyReLU(),
-          tf.keras.layers.Dropout(0.3),
-      
-          tf.keras.layers.Conv2D(512, (4, 4), strides=(2, 2), padding='same'),
-          tf.keras.layers.LeakyReLU(),
-          tf.keras.layers.Dropout(0.3),
-
-          tf.keras.layers.Flatten(),
-          tf.keras.layers.Dense(1),
-      ],
-      name="discriminator",
-  )
-  latent_dim = 100
-  generator = tf.keras.Sequential(
-      [
-          tf.keras.layers.InputLayer(latent_dim),
-          tf.keras.layers.Dense(128 * 128 * 128, use_bias=False, input_shape=(100,)),
-          tf.keras.layers.BatchNormalization(),
-          tf.keras.layers.LeakyReLU(),
-
-          tf.keras.layers.Reshape((128, 128, 128)),
-          tf.keras.layers.Conv2DTranspose(64, (4, 4), strides=early_stride, padding='same', use_bias=False),
-          tf.keras.layers.BatchNormalization(),
-          tf.keras.layers.LeakyReLU(),
-
-          tf.keras.layers.Conv2DTranspose(32, (4, 4), strides=(2, 2), padding='same', use_bias=False),
-          tf.keras.layers.BatchNormalization(),
-          tf.keras.layers.LeakyReLU(),
-
-          tf.keras.layers.Conv2DTranspose(3, (4, 4), strides=late_stride, padding='same', use_bias=False, activation='sigmoid'),
-      ],
-      name="generator",
-  )
-  gan = GAN(discriminator=discriminator, generator=generator, latent_dim=latent_dim)
-  gan.compile(
-      d_optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
-      g_optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
-      loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True),
-  )
-  checkpoint = tf.train.Checkpoint(gan)
-  checkpoint.restore(tf.train.latest_checkpoint(ckpts_path))
-  return gan
-
-def create_extractor(discriminator):
-  input = tf.keras.layers.Input(shape=(512, 512, 3))
-  extractor = tf.keras.models.Model(discriminator.layers[0].input, discriminator.layers[-3].output)
-  extractor.trainable = False
-  x = extractor(input)
-  x = tf.keras.layers.GlobalAveragePooling2D()(x)
-  return tf.keras.models.Model(input, x)
-
-def extract_features(extractor, type='all'):
-  dir = "/content/gdrive/MyDrive/dataset"
-  ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", data_dir=dir, shuffle_files=True)
-  train = ds['train'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-  test = ds['test'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-
-  if type == 'all':
-    features = []
-    labels = []
-    for i, sample in enumerate(train):
-      features.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-      labels.append(sample[1])
-      print('\rTraining Dataset to list: %.0f%%'%(((i+1)/len(train))*100), end='')
-    test_feats = []
-    test_labs = []
-    for i, sample in enumerate(test):
-      test_feats.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-      test_labs.append(sample[1])
-      print('\rValidation Dataset to list: %.0f%%'%(((i+1)/len(test))*100), end='')
-    return np.array(features), np.array(labels), np.array(test_feats), np.array(test_labs)
-  elif type == 'train':
-    features = []
-    labels = []
-    for i, sample in enumerate(train):
-      features.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-      labels.append(sample[1])
-      print('\rTraining Dataset to list: %.0f%%'%(((i+1)/len(train))*100), end='')
-    return np.array(features), np.array(labels)
-  else:
-    test_feats = []
-    test_labs = []
-    for i, sample in enumerate(test):
-      test_feats.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-      test_labs.append(sample[1])
-      print('\rValidation Dataset to list: %.0f%%'%(((i+1)/len(test))*100), end='')
-    return np.array(test_feats), np.array(test_labs)
+# GANs, feature extraction, regressors, scoring service and benchmarks: retinopathy_gan.py of this repository
+from retinopathy_gan import *
+from score_images import Scorer, save_regressor, load_regressor, score_directory
+
+image_shards_dir = "/content/gdrive/MyDrive/image_shards"
+feature_cache_dir = "/content/gdrive/MyDrive/feature_cache"
 
 """# Diabetic Retinopathy Detection Dataset"""
 
@@ -227,17 +104,34 @@ builder.download_and_prepare(download_dir='dr2015-resized')
 !zip -r /content/dataset.zip /content/diabetic_retinopathy_detection
 files.download('/content/dataset.zip')
 
+"""Offline, parallel alternative to the tfds preparation (`build_dataset.py`, also runnable as `python build_dataset.py IMAGE_DIR LABELS_CSV OUT_DIR`): btgraham-300 shards of both splits straight from the raw images, one worker process per shard, resumable per shard and checked against sha256 checksums. The test labels are Kaggle's published `retinopathy_solution.csv`. Once built, pass `shards_dir=image_shards_dir` to `extract_features` and train on the shards below (this replaces the tfds conversion in the next section)
+"""
+
+# build_image_shards('/content/dr2015-resized/manual/train', '/content/dr2015-resized/manual/trainLabels.csv',
+#                    os.path.join(image_shards_dir, 'train'))
+# build_image_shards('/content/dr2015-resized/manual/test', '/content/dr2015-resized/manual/retinopathy_solution.csv',
+#                    os.path.join(image_shards_dir, 'test'))
+
 """# Retinopathy Sample Generation
 
 ## Load Dataset for GAN Training
+
+One-time conversion to pre-decoded, pre-resized shards: every later epoch and extraction run skips JPEG decode and resize
 """
 
 # dir = "/content/gdrive/MyDrive/dataset"
 # ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", data_dir=dir)
-# train_test = ds['train'].concatenate(ds['test'])
-# train_test = train_test.map(lambda image: tf.image.resize(tf.image.convert_image_dtype(image['image'], dtype=tf.float32), [512, 512]))
+# for split in ['train', 'test']:
+#   write_image_shards(ds[split], os.path.join(image_shards_dir, split))
+
+"""Training dataset"""
+
 # batch_size = 18
-# train_test = train_test.batch(batch_size)
+# def train_test(epoch):
+#   # Files are shuffled with a per-epoch seed, so a resumed epoch replays the same batch order
+#   ds = load_image_shards(os.path.join(image_shards_dir, 'train'), shuffle_files=True, seed=epoch).concatenate(
+#       load_image_shards(os.path.join(image_shards_dir, 'test'), shuffle_files=True, seed=epoch))
+#   return ds.map(lambda image, label: image).batch(batch_size).prefetch(tf.data.AUTOTUNE)
 
 """## First GAN
 
@@ -303,43 +197,6 @@ generator = tf.keras.Sequential(
 )
 generator.summary()
 
-"""First GAN Model"""
-
-class GAN(tf.keras.Model):
-    def __init__(self, discriminator, generator, latent_dim):
-        super(GAN, self).__init__()
-        self.latent_dim = latent_dim
-        self.discriminator = discriminator
-        self.generator = generator
-
-    def compile(self, d_optimizer, g_optimizer, loss_fn):
-        super(GAN, self).compile()
-        self.loss_fn = loss_fn
-        self.discriminator_optimizer = d_optimizer
-        self.generator_optimizer = g_optimizer
-
-    def train_step(self, images):
-        noise = tf.random.normal([batch_size, latent_dim])
-
-        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
-          generated_images = self.generator(noise, training=True)
-
-          real_output = self.discriminator(images, training=True)
-          fake_output = self.discriminator(generated_images, training=True)
-
-          gen_loss = self.loss_fn(tf.ones_like(fake_output), fake_output)
-
-          real_loss = self.loss_fn(tf.ones_like(real_output), real_output)
-          fake_loss = self.loss_fn(tf.zeros_like(fake_output), fake_output)
-          disc_loss = real_loss + fake_loss
-
-        gradients_of_generator = gen_tape.gradient(gen_loss, self.generator.trainable_variables)
-        gradients_of_discriminator = disc_tape.gradient(disc_loss, self.discriminator.trainable_variables)
-
-        self.generator_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
-        self.discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
-        return {"d_loss": disc_loss, "g_loss": gen_loss}
-
 """Checkpoint save and restore"""
 
 epochs = 10  # In practice, use ~300 epochs
@@ -349,21 +206,15 @@ if gan1 is None:
   gan1.compile(
       d_optimizer=tf.keras.optimizers.Adam(learning_rate=0.0001),
       g_optimizer=tf.keras.optimizers.Adam(learning_rate=0.0001),
-      loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+      loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE),
   )
 
   checkpoint = tf.train.Checkpoint(gan1)
   manager = tf.train.CheckpointManager(checkpoint, '/content/gdrive/My Drive/normal_gan_ckpts', max_to_keep=2)
-  checkpoint.restore(tf.train.latest_checkpoint('/content/gdrive/My Drive/normal_gan_ckpts'))
+  discriminator.checkpoint_path = tf.train.latest_checkpoint('/content/gdrive/My Drive/normal_gan_ckpts')
+  checkpoint.restore(discriminator.checkpoint_path)
 
-class MyCallback(tf.keras.callbacks.Callback):
- def on_epoch_end(self, epoch, logs=None):
-   # manager.save()
-   predictions = self.model.generator(tf.random.normal([1, latent_dim]), training=False)
-   fig = plt.figure(figsize=(3, 3))
-   plt.imshow(predictions[0])
-   plt.axis('off')
-   plt.show()
+preview_callback = PreviewCallback('/content/gdrive/My Drive/normal_gan_previews', every=5)
 
 """Plot generated image"""
 
@@ -373,7 +224,45 @@ px.imshow(generatedImage[0])
 
 """### First GAN Training"""
 
-# gan1.fit(train_test, epochs=epochs, callbacks=[MyCallback()])
+# Saves every 500 steps and at most every 10 minutes, and resumes from the latest valid checkpoint
+# gan1 = train_gan(1, train_test, epochs, callbacks=[preview_callback], checkpoint_every_steps=500)
+
+"""Data-parallel training: every batch of `train_test` is split across the replicas of the strategy"""
+
+# gan1 = train_gan(1, train_test, epochs, strategy=tf.distribute.MirroredStrategy(), callbacks=[preview_callback])
+
+"""Distributed vs single-device parity on two logical CPU devices (run in a fresh runtime)"""
+
+# print('max weight diff: %g, max loss diff: %g'%check_distributed_parity(1, make_cpu_strategy(2)))
+
+"""Train step time of the default and the fast (XLA, mixed precision) training modes
+
+On CPU use `mixed_bfloat16`; on GPU use `mixed_float16`, which also enables loss scaling on both optimizers
+
+Measured on CPU (1 vCPU without bfloat16 instructions, 5 GB RAM, TensorFlow 2.21; median step after the first, batch 2). The default mode runs the same ops as the training step before the fast mode was added:
+
+| Model | default | XLA | XLA + mixed_bfloat16 |
+|---|---|---|---|
+| First GAN, dense generator | out of memory (> 5.7 GB) | 3.67 s (4.6 GB peak) | 3.69 s (5.1 GB peak) |
+| Second GAN, dense generator | out of memory | 4.91 s (4.8 GB peak) | 5.09 s (5.3 GB peak) |
+| First GAN, progressive generator | 1.21 s (1.2 GB peak) | 2.80 s (1.7 GB peak) | 2.81 s (1.8 GB peak) |
+| First GAN, progressive generator, batch 4 | 2.45 s | 4.89 s | 5.80 s |
+
+On such a host XLA mostly saves memory, and bfloat16 has no hardware path; the speedups are expected on GPU (`mixed_float16`), which was not measured
+"""
+
+# for mode, kwargs in [('default', {}),
+#                      ('XLA', {'jit_compile': True}),
+#                      ('XLA + mixed_bfloat16', {'jit_compile': True, 'mixed_precision': 'mixed_bfloat16'})]:
+#   print('%s: %.3fs/step'%(mode, time_train_step(build_gan(1, **kwargs))))
+
+"""Memory-efficient generator: parameters, peak RSS, checkpoint size and step time against the original dense-stem generator
+
+Train it with `train_gan(1, train_test, epochs, generator_arch='progressive')`
+"""
+
+# for result in benchmark_generators(1):
+#   print("%(generator_arch)-12s params: %(generator_params)11d  peak RSS: %(peak_rss_mb)8.0f MB  checkpoint: %(checkpoint_mb)7.1f MB  step: %(step_time).3fs"%result)
 
 """## Second GAN
 
@@ -439,44 +328,6 @@ generator = tf.keras.Sequential(
 )
 generator.summary()
 
-"""Second GAN Model"""
-
-class GAN(tf.keras.Model):
-    def __init__(self, discriminator, generator, latent_dim):
-        super(GAN, self).__init__()
-        self.latent_dim = latent_dim
-        self.discriminator = discriminator
-        self.generator = generator
-
-
-    def compile(self, d_optimizer, g_optimizer, loss_fn):
-        super(GAN, self).compile()
-        self.loss_fn = loss_fn
-        self.discriminator_optimizer = d_optimizer
-        self.generator_optimizer = g_optimizer
-
-    def train_step(self, images):
-        noise = tf.random.normal([batch_size, latent_dim])
-
-        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
-          generated_images = self.generator(noise, training=True)
-
-          real_output = self.discriminator(images, training=True)
-          fake_output = self.discriminator(generated_images, training=True)
-
-          gen_loss = self.loss_fn(tf.ones_like(fake_output), fake_output)
-
-          real_loss = self.loss_fn(tf.ones_like(real_output), real_output)
-          fake_loss = self.loss_fn(tf.zeros_like(fake_output), fake_output)
-          disc_loss = real_loss + fake_loss
-
-        gradients_of_generator = gen_tape.gradient(gen_loss, self.generator.trainable_variables)
-        gradients_of_discriminator = disc_tape.gradient(disc_loss, self.discriminator.trainable_variables)
-
-        self.generator_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
-        self.discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
-        return {"d_loss": disc_loss, "g_loss": gen_loss}
-
 """Checkpoint save and restore"""
 
 epochs = 10  # In practice, use ~300 epochs
@@ -486,21 +337,15 @@ if gan2 is None:
   gan2.compile(
       d_optimizer=tf.keras.optimizers.Adam(learning_rate=0.00001),
       g_optimizer=tf.keras.optimizers.Adam(learning_rate=0.00001),
-      loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+      loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE),
   )
 
   checkpoint = tf.train.Checkpoint(gan2)
   manager = tf.train.CheckpointManager(checkpoint, '/content/gdrive/My Drive/deep_aug_dims_ckpts', max_to_keep=2)
-  checkpoint.restore(tf.train.latest_checkpoint('/content/gdrive/My Drive/deep_aug_dims_ckpts'))
+  discriminator.checkpoint_path = tf.train.latest_checkpoint('/content/gdrive/My Drive/deep_aug_dims_ckpts')
+  checkpoint.restore(discriminator.checkpoint_path)
 
-class MyCallback(tf.keras.callbacks.Callback):
- def on_epoch_end(self, epoch, logs=None):
-   # manager.save()
-   predictions = self.model.generator(tf.random.normal([1, latent_dim]), training=False)
-   fig = plt.figure(figsize=(3, 3))
-   plt.imshow(predictions[0])
-   plt.axis('off')
-   plt.show()
+preview_callback = PreviewCallback('/content/gdrive/My Drive/deep_aug_dims_previews', every=5)
 
 """Plot generated images"""
 
@@ -510,7 +355,16 @@ px.imshow(generatedImage[0])
 
 """### Second GAN Training"""
 
-# gan2.fit(train_test, epochs=epochs, callbacks=[MyCallback()])
+# Saves every 500 steps and at most every 10 minutes, and resumes from the latest valid checkpoint
+# gan2 = train_gan(2, train_test, epochs, callbacks=[preview_callback], checkpoint_every_steps=500)
+
+"""## Synthetic Images Generation
+
+Writes sharded images and a manifest from a seeded latent stream
+"""
+
+# generate_images(gan1, 10000, '/content/gdrive/MyDrive/synthetic/normal_gan', seed=0)
+# generate_images(gan2, 10000, '/content/gdrive/MyDrive/synthetic/deep_aug_dims', seed=0)
 
 """# Features Extraction
 
@@ -519,154 +373,81 @@ px.imshow(generatedImage[0])
 Extractor build
 """
 
-if gan1 is None: gan1 = restore_gan(1)
-
-input = tf.keras.layers.Input(shape=(512, 512, 3))
-extractor = tf.keras.models.Model(gan1.discriminator.layers[0].input, gan1.discriminator.layers[-3].output)
-extractor.trainable = False
-x = extractor(input)
-x = tf.keras.layers.GlobalAveragePooling2D()(x)
-extractor = tf.keras.models.Model(input, x)
-
-"""Feature extraction"""
-
-dir = "/content/gdrive/MyDrive/dataset"
-ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", data_dir=dir, shuffle_files=True)
-train = ds['train'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-test = ds['test'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-
-features = []
-labels = []
-for i, sample in enumerate(train):
-  features.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-  labels.append(sample[1])
-  print('\rTraining Dataset to list: %.0f%%'%(((i+1)/len(train))*100), end='')
-features = np.array(features)
-labels = np.array(labels)
-
-test_feats = []
-test_labs = []
-for i, sample in enumerate(test):
-  test_feats.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-  test_labs.append(sample[1])
-  print('\rValidation Dataset to list: %.0f%%'%(((i+1)/len(test))*100), end='')
-test_feats = np.array(test_feats)
-test_labs = np.array(test_labs)
+gan1_discriminator = gan1.discriminator if gan1 is not None else restore_discriminator(1)
+gan1_extractor = create_extractor(gan1_discriminator)
 
 """## Second GAN Extractor
 
 Extractor build
 """
 
-if gan2 is None: gan2 = restore_gan(2)
-
-input = tf.keras.layers.Input(shape=(512, 512, 3))
-extractor = tf.keras.models.Model(gan2.discriminator.layers[0].input, gan2.discriminator.layers[-3].output)
-extractor.trainable = False
-x = extractor(input)
-x = tf.keras.layers.GlobalAveragePooling2D()(x)
-extractor = tf.keras.models.Model(input, x)
-
-"""Features extraction"""
-
-dir = "/content/gdrive/MyDrive/dataset"
-ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", data_dir=dir, shuffle_files=True)
-train = ds['train'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-test = ds['test'].map(lambda sample: (tf.image.resize(tf.image.convert_image_dtype(sample['image'], dtype=tf.float32), [512, 512]), tf.cast(sample['label'], tf.float32)))
-
-features = []
-labels = []
-for i, sample in enumerate(train):
-  features.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-  labels.append(sample[1])
-  print('\rTraining Dataset to list: %.0f%%'%(((i+1)/len(train))*100), end='')
-features = np.array(features)
-labels = np.array(labels)
-
-test_feats = []
-test_labs = []
-for i, sample in enumerate(test):
-  test_feats.append(extractor(tf.expand_dims(sample[0], axis=0))[0])
-  test_labs.append(sample[1])
-  print('\rValidation Dataset to list: %.0f%%'%(((i+1)/len(test))*100), end='')
-test_feats = np.array(test_feats)
-test_labs = np.array(test_labs)
+gan2_discriminator = gan2.discriminator if gan2 is not None else restore_discriminator(2)
+gan2_extractor = create_extractor(gan2_discriminator)
+
+"""Cold start and peak memory of a scoring process: full GAN restore vs discriminator-only restore"""
+
+# for result in benchmark_restore(2):
+#   print("%(mode)-14s cold start: %(cold_start)6.2fs  peak RSS: %(peak_rss_mb)8.0f MB"%result)
+
+"""## Features extraction
+
+Both extractors share a single decode and resize pass over the dataset
+"""
+
+(gan1_feats, gan1_labs, gan1_test_feats, gan1_test_labs), (gan2_feats, gan2_labs, gan2_test_feats, gan2_test_labs) = \
+    extract_features_multi([gan1_extractor, gan2_extractor], cache_dir=feature_cache_dir)
+
+"""## Extraction resolution
+
+The extractor is fully convolutional, so the 512x512 upsampling is optional; compare throughput and downstream MAE at lower and native resolution
+"""
+
+# for result in compare_extraction_resolutions(gan2_discriminator):
+#   print("%(image_size)-8s %(images_per_sec)8.1f images/sec (x%(speedup).2f)  MAE: %(mae).4f (%(mae_change)+.4f)"%result)
+
+"""## Extractor export
+
+Standalone, dropout-free extractor for CPU inference: SavedModel, or TFLite with optional float16/int8 post-training quantization, checked against the float32 features
+"""
+
+# export_dir = '/content/gdrive/MyDrive/extractor_export'
+# os.makedirs(export_dir, exist_ok=True)
+# export_extractor(gan2_extractor, os.path.join(export_dir, 'gan2_extractor'), format='saved_model')
+# check_images = np.stack(list(calibration_images(64).as_numpy_iterator()))
+# for quantization in [None, 'float16', 'int8']:
+#   tflite_path = export_extractor(gan2_extractor, os.path.join(export_dir, 'gan2_extractor_%s.tflite'%(quantization or 'float32')), quantization=quantization)
+#   print(quantization or 'float32', check_exported_extractor(gan2_extractor, tflite_path, check_images))
 
 """# Cross validation"""
 
 n_folds = 5
-if gan2 is None: gan2 = restore_gan(2)
-extractor = create_extractor(gan2.discriminator)
-features, labels = extract_features(extractor, type='train')
+extractor = create_extractor(gan2.discriminator if gan2 is not None else restore_discriminator(2))
+features, labels = extract_features(extractor, type='train', cache_dir=feature_cache_dir, out_of_core=True)
 skf = StratifiedKFold(n_folds)
 
-class Regressor(tf.keras.Model):
-    def __init__(self, parameters):
-        super(Regressor, self).__init__()
-        self.parameters = parameters
-        self.M = tf.Variable(tf.zeros([self.parameters]), dtype = tf.float32, trainable=True)
-
-    def call(self, val_feats):
-        return tf.tensordot(val_feats, self.M, axes=1)
-
-    def compile(self, optimizer):
-        super(Regressor, self).compile()
-        self.optimizer = optimizer
-
-    def train_on_batch(self, train_samples, train_labs, val_feats, val_labs, weights):
-
-        with tf.GradientTape() as tape:
-          labels_pred = tf.tensordot(train_samples, self.M, axes=1)
-          train_weights = np.zeros(len(train_labs))
-          for i, lab in enumerate(train_labs):
-            train_weights[i] = weights[int(lab)]
-          loss = tf.reduce_mean(train_weights * tf.square(train_labs - labels_pred))
-
-        grads = tape.gradient(loss, self.trainable_variables)
-        self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
-
-        if val_feats is not None and val_labs is not None:
-          labels_val = tf.tensordot(val_feats, self.M, axes=1)
-          val_weights = np.zeros(len(val_labs))
-          for i, lab in enumerate(val_labs):
-            val_weights[i] = weights[int(lab)]
-          val_loss = mean_squared_error(val_labs, labels_val, sample_weight=val_weights)
-          return loss.numpy(), val_loss
-
-        return loss.numpy()
-
-def make_weights(labels, type):
-  weights = None
-  if type == 'class':
-    labels_count = np.zeros(5)
-    for l in labels:
-      labels_count[int(l)] += 1
-    weights = np.zeros(5)
-    for i, class_ in enumerate(weights):
-      weights[i] = tf.cast(len(labels) / (labels_count[i] * 5), tf.float32)
-  elif type == 'sample':
-    labels_count = np.zeros(5)
-    for l in labels:
-      labels_count[int(l)] += 1
-    weights = []
-    for i, label in enumerate(labels):
-      weights.insert(i, tf.cast(len(labels) / (labels_count[int(label)] * 5), tf.float32).numpy())
-  else:
-    print('Method not found')
-  return weights
-
-def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_feats, val_labs):
+def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_feats, val_labs, solver='closed_form', ridge=0.0,
+                             val_every=1, patience=None, method='cholesky'):
 
   if model_name == "LR_Analytical_Optimization":
     weights = make_weights(train_labs, 'class')
     start = time.time()
-    train_samples = tf.concat([train_feats, np.ones((len(train_feats), 1))], axis=-1)
-    val_samples = tf.concat([val_feats, np.ones((len(val_feats), 1))], axis=-1)
-    regressor = Regressor(parameters = extractor.output.shape[-1] + 1)
-    regressor.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.1))
-    for i in range(0, epochs):
-      train_loss, val_loss = regressor.train_on_batch(train_samples, train_labs, val_samples, val_labs, weights)
-      print('\r\t\tEpoch: %d || train_loss: %f - val_loss: %f'%(i+1, train_loss, val_loss), end='')
+    val_samples = tf.concat([np.asarray(val_feats, dtype=np.float32), np.ones((len(val_feats), 1))], axis=-1)
+    regressor = Regressor(parameters = train_feats.shape[-1] + 1)
+    if solver == 'closed_form':
+      if method == 'cholesky':
+        # Accumulated chunk by chunk, so memory-mapped features are never loaded whole
+        regressor.fit_stats(class_gram_stats(train_feats, train_labs), weights, ridge)
+      else:
+        train_samples = tf.concat([np.asarray(train_feats, dtype=np.float32), np.ones((len(train_feats), 1))], axis=-1)
+        regressor.fit_analytical(train_samples, train_labs, weights, ridge, method)
+      val_weights = np.asarray(weights)[np.asarray(val_labs).astype(int)]
+      val_loss = mean_squared_error(val_labs, regressor(val_samples), sample_weight=val_weights)
+      print('\t\tval_loss: %f'%(val_loss), end='')
+    else:
+      regressor.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.1))
+      train_losses, _, val_loss = regressor.fit_gradient_stats(class_gram_stats(train_feats, train_labs), weights, epochs,
+                                                               class_gram_stats(val_feats, val_labs), val_every, patience)
+      print('\t\tEpochs: %d || train_loss: %f - val_loss: %f'%(len(train_losses), train_losses[-1], val_loss), end='')
     interval = time.time() - start
 
   elif model_name == "LR_SKlearn":
@@ -677,6 +458,8 @@ def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_fe
       val_weights[i] = c_weights[int(lab)]
       start = time.time()
     reg = LinearRegression()
+    # sklearn validates the features into an in-memory float64 copy, so this
+    # backend still loads the memory-mapped features whole
     reg.fit(train_feats, train_labs, sample_weight=weights)
     preds = reg.predict(val_feats)
     val_loss = mean_squared_error(val_labs, preds, sample_weight=val_weights)
@@ -684,127 +467,128 @@ def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_fe
     interval = time.time() - start
 
   elif model_name == "LR_Keras_Dense_Layer":
-    weights = make_weights(train_labs, 'class')
-    c_w = {0: weights[0], 1: weights[1], 2: weights[2], 3: weights[3], 4: weights[4]}
-    val_weights = np.zeros(len(val_labs))
-    for i, lab in enumerate(val_labs):
-      val_weights[i] = weights[int(lab)]
     start = time.time()
-    input = tf.keras.layers.Input(shape=extractor.output.shape[-1])
-    output = tf.keras.layers.Dense(units=1)(input)
-    regressor = tf.keras.models.Model(input, output)
-    regressor.compile(optimizer=tf.optimizers.Adam(learning_rate=0.1), loss='mse')
-    for i in range(0, epochs):
-      train_loss = regressor.train_on_batch(train_feats, train_labs, class_weight=c_w)
-      val_loss = mean_squared_error(val_labs, regressor(val_feats), sample_weight=val_weights)
-      print('\r\t\tEpoch: %d || train_loss: %f - val_loss: %f'%(i+1, train_loss, val_loss), end='')
+    val_loss = fit_keras_dense(train_feats, train_labs, epochs, val_feats, val_labs)
     interval = time.time() - start
 
   return val_loss, interval
 
 models = ["LR_Analytical_Optimization", "LR_SKlearn", "LR_Keras_Dense_Layer"]
 
-validation_losses = {}
-for model_name in models:
-  print("Model: %s"%(model_name))
-  partial_val_loss = []
-  m_interval = 0
-  for i, (train_index, test_index) in enumerate(skf.split(features, labels)):
-    print("\tFold: %d/%d"%(i+1, n_folds))
-    train_feats = features[train_index]
-    train_labs = labels[train_index]
-    val_feats = features[train_index]
-    val_labs = labels[train_index]
-    start = time.time()
-    val_loss, interval = train_and_evaluate_model(model_name, train_feats, train_labs, 2000, val_feats, val_labs)
-    m_interval += interval
-    partial_val_loss.append(val_loss)
-    print()
-  validation_losses[model_name] = (np.mean(partial_val_loss), m_interval/5)
-  print()
+def run_cv_task(model_name, fold, features_path, labels, train_index, test_index, epochs):
+  # Workers run on the CPU, leaving the GPU to the parent process, and share
+  # one TF/BLAS thread budget with their siblings
+  try:
+    tf.config.set_visible_devices([], 'GPU')
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+  except RuntimeError:
+    pass
+  features = np.load(features_path, mmap_mode='r')
+  start = time.time()
+  val_loss, interval = train_and_evaluate_model(model_name, features[train_index], labels[train_index], epochs,
+                                                features[test_index], labels[test_index])
+  return {'model': model_name, 'fold': fold, 'val_loss': float(val_loss), 'interval': interval,
+          'wall_time': time.time() - start, 'pid': os.getpid()}
+
+def cross_validate_parallel(models, features, labels, skf, epochs, n_jobs=-1):
+  # The feature matrix is written once to shared memory and memory-mapped by
+  # every worker instead of being pickled into each task
+  tmp = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+  # Features already memory-mapped from a .npy (out-of-core extraction, the feature cache) are not copied
+  features_path = npy_file(features)
+  if features_path is None:
+    features_path = os.path.join(tmp, 'features.npy')
+    np.save(features_path, features)
+  labels = np.asarray(labels)
+  folds = list(skf.split(np.zeros(len(labels)), labels))
+
+  start = time.time()
+  try:
+    timings = joblib.Parallel(n_jobs=n_jobs, backend='loky')(
+        joblib.delayed(run_cv_task)(model_name, i, features_path, labels, train_index, test_index, epochs)
+        for model_name in models for i, (train_index, test_index) in enumerate(folds))
+  finally:
+    shutil.rmtree(tmp)
+  print('%d tasks in %.1fs'%(len(timings), time.time() - start))
+
+  validation_losses = {}
+  for model_name in models:
+    tasks = [t for t in timings if t['model'] == model_name]
+    validation_losses[model_name] = (np.mean([t['val_loss'] for t in tasks]), np.mean([t['interval'] for t in tasks]))
+  return validation_losses, timings
+
+validation_losses, cv_timings = cross_validate_parallel(models, features, labels, skf, 2000)
+for t in cv_timings:
+  print("%-28s Fold: %d/%d || val_loss: %f - fit: %.2fs - task: %.2fs (pid %d)"%(t['model'], t['fold']+1, n_folds, t['val_loss'], t['interval'], t['wall_time'], t['pid']))
 
 validation_losses
 
+"""Closed-form cross-validation of all folds at once
+
+Per-fold Gram statistics are computed once; each fold's training system is the total minus its held-out block, and all folds are solved as one batched linear solve
+"""
+
+def cross_validate_gram(features, labels, skf, ridge=0.0):
+  labels = np.asarray(labels)
+  blocks = [class_gram_stats(features, labels, test_index) for _, test_index in skf.split(np.zeros(len(labels)), labels)]
+  gram = np.stack([b['gram'] for b in blocks])
+  moment = np.stack([b['moment'] for b in blocks])
+  label_sq = np.stack([b['label_sq'] for b in blocks])
+  counts = np.stack([b['counts'] for b in blocks])
+
+  # Class weights as make_weights computes them on each fold's training labels
+  train_counts = counts.sum(0) - counts
+  class_weights = (train_counts.sum(1, keepdims=True) / (train_counts * 5)).astype(np.float32).astype(np.float64)
+  penalty = np.full(gram.shape[-1], ridge)
+  penalty[-1] = 0
+  a = np.einsum('fc,fcij->fij', class_weights, gram.sum(0) - gram) + np.diag(penalty)
+  b = np.einsum('fc,fci->fi', class_weights, moment.sum(0) - moment)
+  try:
+    weights = np.linalg.solve(a, b[..., None])[..., 0]
+  except np.linalg.LinAlgError:
+    weights = np.stack([np.linalg.lstsq(a_f, b_f, rcond=None)[0] for a_f, b_f in zip(a, b)])
+
+  # Weighted squared error of each held-out block, expanded from its statistics
+  squared_error = np.einsum('fi,fcij,fj->fc', weights, gram, weights) - 2 * np.einsum('fi,fci->fc', weights, moment) + label_sq
+  val_losses = (class_weights * squared_error).sum(1) / (class_weights * counts).sum(1)
+  return val_losses, weights
+
+start = time.time()
+gram_val_losses, gram_weights = cross_validate_gram(features, labels, skf)
+for i, val_loss in enumerate(gram_val_losses):
+  print("\tFold: %d/%d || val_loss: %f"%(i+1, n_folds, val_loss))
+print("LR_Analytical_Optimization (all folds): %f in %.2fs"%(np.mean(gram_val_losses), time.time() - start))
+
 """# Linear regression"""
 
-class Regressor(tf.keras.Model):
-    def __init__(self, parameters):
-        super(Regressor, self).__init__()
-        self.parameters = parameters
-        self.M = tf.Variable(tf.zeros([self.parameters]), dtype = tf.float32, trainable=True)
-
-    def call(self, val_feats):
-        return tf.tensordot(val_feats, self.M, axes=1)
-
-    def compile(self, optimizer):
-        super(Regressor, self).compile()
-        self.optimizer = optimizer
-
-    def train_on_batch(self, train_samples, train_labs, val_feats, val_labs, weights):
-
-        with tf.GradientTape() as tape:
-          labels_pred = tf.tensordot(train_samples, self.M, axes=1)
-          train_weights = np.zeros(len(train_labs))
-          for i, lab in enumerate(train_labs):
-            train_weights[i] = weights[int(lab)]
-          loss = tf.reduce_mean(train_weights * tf.square(train_labs - labels_pred))
-
-        grads = tape.gradient(loss, self.trainable_variables)
-        self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
-
-        if val_feats is not None and val_labs is not None:
-          labels_val = tf.tensordot(val_feats, self.M, axes=1)
-          val_weights = np.zeros(len(val_labs))
-          for i, lab in enumerate(val_labs):
-            val_weights[i] = weights[int(lab)]
-          val_loss = mean_squared_error(val_labs, labels_val, sample_weight=val_weights)
-          return loss.numpy(), val_loss
-
-        return loss.numpy()
-
-import copy
-
-def make_weights(labels, type):
-  weights = None
-  if type == 'class':
-    labels_count = np.zeros(5)
-    for l in labels:
-      labels_count[int(l)] += 1
-    weights = np.zeros(5)
-    for i, class_ in enumerate(weights):
-      weights[i] = tf.cast(len(labels) / (labels_count[i] * 5), tf.float32)
-  elif type == 'sample':
-    labels_count = np.zeros(5)
-    for l in labels:
-      labels_count[int(l)] += 1
-    weights = []
-    for i, label in enumerate(labels):
-      weights.insert(i, tf.cast(len(labels) / (labels_count[int(label)] * 5), tf.float32).numpy())
-  else:
-    print('Method not found')
-  return weights
-
-def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_feats, val_labs):
+def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_feats, val_labs, solver='closed_form', ridge=0.0,
+                             val_every=1, patience=None, method='cholesky'):
 
   if model_name == "LR_Analytical_Optimization":
     evals = []
     weights = make_weights(train_labs, 'class')
-    train_samples = tf.concat([train_feats, np.ones((len(train_feats), 1))], axis=-1)
-    val_samples = tf.concat([val_feats, np.ones((len(val_feats), 1))], axis=-1)
-    regressor = Regressor(parameters = extractor.output.shape[-1] + 1)
-    regressor.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.1))
-    best_ckpts = {'Model': None, 'val_loss': None}
-    eps = []
-    for i in range(0, epochs):
-      train_loss, val_loss = regressor.train_on_batch(train_samples, train_labs, val_samples, val_labs, weights)
-      evals.append(val_loss)
-      # train_loss, _ = regressor.train_on_batch(train_samples, train_labs, weights=weights)
-      print('\r\t\tEpoch: %d || train_loss: %f - val_loss: %f'%(i+1, train_loss, val_loss), end='')
-      if best_ckpts['val_loss'] is None or best_ckpts['val_loss'] > val_loss: 
-        eps.append(i)
-        best_ckpts = {'Model': copy.copy(regressor), 'val_loss': val_loss}
-    print('\r\nSaved best: ', best_ckpts['val_loss'], end='')
-    predictions = best_ckpts['Model'](val_samples)
+    val_samples = tf.concat([np.asarray(val_feats, dtype=np.float32), np.ones((len(val_feats), 1))], axis=-1)
+    regressor = Regressor(parameters = train_feats.shape[-1] + 1)
+    if solver == 'closed_form':
+      if method == 'cholesky':
+        # Accumulated chunk by chunk, so memory-mapped features are never loaded whole
+        regressor.fit_stats(class_gram_stats(train_feats, train_labs), weights, ridge)
+      else:
+        train_samples = tf.concat([np.asarray(train_feats, dtype=np.float32), np.ones((len(train_feats), 1))], axis=-1)
+        regressor.fit_analytical(train_samples, train_labs, weights, ridge, method)
+      predictions = regressor(val_samples)
+      val_weights = np.asarray(weights)[np.asarray(val_labs).astype(int)]
+      evals.append(mean_squared_error(val_labs, predictions, sample_weight=val_weights))
+      print('\t\tval_loss: %f'%(evals[-1]), end='')
+    else:
+      regressor.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.1))
+      train_losses, val_losses, best_loss = regressor.fit_gradient_stats(class_gram_stats(train_feats, train_labs), weights, epochs,
+                                                                         class_gram_stats(val_feats, val_labs), val_every, patience)
+      evals += list(val_losses)
+      print('\t\tEpochs: %d || train_loss: %f - val_loss: %f'%(len(train_losses), train_losses[-1], val_losses[-1]), end='')
+      print('\r\nSaved best: ', best_loss, end='')
+      predictions = regressor(val_samples)
     val_loss = evals
 
   elif model_name == "LR_SKlearn":
@@ -814,6 +598,8 @@ def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_fe
     for i, lab in enumerate(val_labs):
       val_weights[i] = c_weights[int(lab)]
     reg = LinearRegression()
+    # sklearn validates the features into an in-memory float64 copy, so this
+    # backend still loads the memory-mapped features whole
     reg.fit(train_feats, train_labs, sample_weight=weights)
     predictions = reg.predict(val_feats)
     val_loss = mean_squared_error(val_labs, predictions, sample_weight=val_weights)
@@ -821,10 +607,9 @@ def train_and_evaluate_model(model_name, train_feats, train_labs, epochs, val_fe
 
   return val_loss, predictions
 
-if gan2 is None: gan2 = restore_gan(2)
-extractor = create_extractor(gan2.discriminator)
-features, labels = extract_features(extractor, type='train')
-test_feats, test_labs = extract_features(extractor, type='test')
+extractor = create_extractor(gan2.discriminator if gan2 is not None else restore_discriminator(2))
+features, labels = extract_features(extractor, type='train', cache_dir=feature_cache_dir, out_of_core=True)
+test_feats, test_labs = extract_features(extractor, type='test', cache_dir=feature_cache_dir, out_of_core=True)
 
 val_loss_sklearn, pred_sklearn = train_and_evaluate_model("LR_SKlearn", 
                                       features, 
@@ -849,4 +634,80 @@ for i, (label, pred_skl, pred_opt) in enumerate(zip(test_labs, pred_sklearn, pre
   else: break
 
 print("\n\nSKLearn MAE: %f \tAnalytical Optimization MAE: %f"%(metrics.mean_absolute_error(test_labs, pred_sklearn), metrics.mean_absolute_error(test_labs, pred_optimization)))
-print("SKLearn RMSE: %f \tAnalytical Optimization RMSE: %f"%(math.sqrt(metrics.mean_squared_error(test_labs, pred_sklearn)), math.sqrt(metrics.mean_squared_error(test_labs, pred_optimization))))
\ No newline at end of file
+print("SKLearn RMSE: %f \tAnalytical Optimization RMSE: %f"%(math.sqrt(metrics.mean_squared_error(test_labs, pred_sklearn)), math.sqrt(metrics.mean_squared_error(test_labs, pred_optimization))))
+
+"""Evaluation report: MAE, class-weighted MSE, quadratic weighted kappa of the rounded grades and confusion matrices, with paired bootstrap confidence intervals"""
+
+evaluation = evaluation_report(test_labs, {"LR_SKlearn": pred_sklearn, "LR_Analytical_Optimization": pred_optimization},
+                               class_weights=make_weights(labels, 'class'))
+
+"""## Incremental updates
+
+The online regressor only keeps the class-weighted sufficient statistics: newly labeled exams are absorbed with `partial_fit` and the refit cost does not depend on how many exams were seen
+"""
+
+online_regressor_path = '/content/gdrive/MyDrive/gan2_online_regressor.npz'
+online = OnlineRegressor(features.shape[-1])
+for feats, labs in iter_feature_chunks(features, labels, chunk_size=4096):
+  online.partial_fit(feats, labs, refit=False)
+start = time.time()
+online.refit()
+print("Refit: %.4fs  train_loss: %f"%(time.time() - start, online.loss()))
+pred_online = online.predict(test_feats)
+print("Online MAE: %f  max diff from Analytical Optimization: %e"%(metrics.mean_absolute_error(test_labs, pred_online), np.max(np.abs(pred_online - np.asarray(pred_optimization)))))
+online.save(online_regressor_path)
+
+# New exams: online = OnlineRegressor.load(online_regressor_path).partial_fit(new_feats, new_labs); online.save(online_regressor_path)
+
+"""# Scoring service
+
+Local HTTP server scoring uploaded fundus images: `POST /score` with the image file as the body returns its severity score, `GET /stats` the latency percentiles and queue depth. Concurrent requests are coalesced into batches of up to `max_batch_size` images, waiting at most `max_wait_ms` for a batch to fill
+"""
+
+reg = LinearRegression()
+# sklearn makes an in-memory float64 copy of the memory-mapped features
+reg.fit(features, labels, sample_weight=make_weights(labels, 'sample'))
+# server = serve_scorer(Scorer(extractor, reg), port=8000, max_batch_size=32, max_wait_ms=10)
+
+"""Load test against localhost"""
+
+# test_dir = '/content/dr2015-resized/manual/test'
+# test_images = [os.path.join(test_dir, name) for name in sorted(os.listdir(test_dir))[:200]]
+# for concurrency in [1, 8, 32, 64]:
+#   server.batcher.reset_stats()
+#   result = load_test('http://127.0.0.1:8000', test_images, n_requests=500, concurrency=concurrency)
+#   print("concurrency: %2d  %7.1f requests/sec  latency p50: %.1f ms  p99: %.1f ms  mean batch: %.1f"%(
+#       concurrency, result['requests_per_sec'], result['latency_ms']['p50'], result['latency_ms']['p99'], result['server']['mean_batch_size']))
+
+# server.shutdown()
+# server.batcher.close()
+
+"""## Directory scoring
+
+Streams an `image_id,score` CSV for a whole directory with `score_images.py`, also runnable outside the notebook; re-running the same command after an interruption skips the images already in the CSV
+"""
+
+regressor_path = '/content/gdrive/MyDrive/gan2_regressor.joblib'
+save_regressor(reg, regressor_path)
+# !python /content/Diabetic-Retinopathy-Scoring-Using-GANs/score_images.py /content/dr2015-resized/manual/test /content/gdrive/MyDrive/test_scores.csv --regressor {regressor_path}
+
+"""# Benchmarks
+
+Offline benchmark suite on synthetic 512x512 images and random 512-d features: extraction throughput, GAN train step of both generators, every `train_and_evaluate_model` backend and `make_weights`. Results are saved as JSON; `compare_benchmarks` diffs two runs
+"""
+
+# report = run_benchmarks()  # written to benchmarks/benchmark-<time>.json
+
+# compare_benchmarks('benchmarks/baseline.json', 'benchmarks/benchmark-<time>.json')
+
+"""# Profiling
+
+Per-stage timings of extraction (read, decode, resize, host-to-device, forward, copy-back) and of the GAN train step (generator and discriminator passes, gradients, optimizer updates). Exported as a Chrome trace plus a summary table; the stages are also annotated in a TensorBoard profile taken with `tf.profiler.experimental.start(logdir)`. Profilers are off by default (`no_profiler`)
+"""
+
+# profiler = StageProfiler()
+# profile_extraction(create_extractor(restore_discriminator(2)), profiler)
+# extract_split([create_extractor(build_discriminator())], synthetic_image_dataset(256), 'synthetic', profiler=profiler)
+# profile_train_step(build_gan(2), profiler)
+# stage_summary = profiler.summary()
+# profiler.export_chrome_trace('/content/gdrive/MyDrive/benchmarks/stages_trace.json')
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Offline preparation of the btgraham-300 image shards
+
+Builds the fixed-size record shards read by load_image_shards straight from the
+raw Kaggle images and their labels CSV, with OpenCV and one worker process per
+shard: no TensorFlow, tfds or network access. Usable from the notebook or as
+
+    python build_dataset.py IMAGE_DIR LABELS_CSV OUT_DIR [--image-size 512 512]
+"""
+
+import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+import concurrent.futures
+
+import numpy as np
+import cv2
+from joblib.externals.loky import ProcessPoolExecutor
+
+def btgraham_preprocess(image, target_radius=300):
+  # Same steps as the btgraham-300 config of the tfds dataset: rescale the eye
+  # to a fixed radius, subtract the local average color, mask and crop the border
+  row = image[image.shape[0] // 2].sum(axis=1)
+  radius = (row > row.mean() / 10).sum() / 2
+  if radius < 1:
+    # As in tfds: on corrupted images the heuristic fails, assume the eye spans the height
+    radius = image.shape[0] / 2
+  scale = target_radius / radius
+  image = cv2.resize(image, dsize=None, fx=scale, fy=scale)
+  image = cv2.addWeighted(image, 4, cv2.GaussianBlur(image, (0, 0), target_radius / 30), -4, 128)
+  mask = np.zeros(image.shape)
+  center = (image.shape[1] // 2, image.shape[0] // 2)
+  mask_radius = int(target_radius * 0.9)
+  cv2.circle(mask, center=center, radius=mask_radius, color=(1, 1, 1), thickness=-1)
+  image = (image * mask + (1 - mask) * 128).astype(np.uint8)
+  return image[max(center[1] - mask_radius, 0):center[1] + mask_radius, max(center[0] - mask_radius, 0):center[0] + mask_radius]
+
+def file_sha256(path, chunk_size=2**24):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def build_shard(out_dir, shard, image_paths, labels, image_size):
+  # Runs in a worker process: raw image -> btgraham-300 -> resize -> record, with OpenCV only
+  path = os.path.join(out_dir, shard)
+  digest = hashlib.sha256()
+  records, skipped = 0, []
+  with open(path + '.tmp', 'wb') as f:
+    for image_path, lab in zip(image_paths, labels):
+      image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+      if image is None:
+        skipped.append(os.path.basename(image_path))
+        continue
+      image = btgraham_preprocess(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+      record = np.uint8(lab).tobytes() + cv2.resize(image, (image_size[1], image_size[0]), interpolation=cv2.INTER_LINEAR).tobytes()
+      digest.update(record)
+      f.write(record)
+      records += 1
+  os.rename(path + '.tmp', path)
+  info = {'file': shard, 'records': records, 'sha256': digest.hexdigest(), 'skipped': skipped}
+  # The sidecar is written last and marks the shard as complete
+  with open(path + '.json.tmp', 'w') as f:
+    json.dump(info, f)
+  os.rename(path + '.json.tmp', path + '.json')
+  return info
+
+def build_image_shards(image_dir, labels_csv, out_dir, image_size=(512, 512), records_per_shard=2048, n_workers=None, seed=0):
+  # Offline replacement for the tfds btgraham-300 preparation: raw images and
+  # their labels CSV (image,level) straight to the write_image_shards format
+  manifest_path = os.path.join(out_dir, 'manifest.json')
+  if os.path.exists(manifest_path):
+    print('Shards already written to %s'%(out_dir))
+    return
+  os.makedirs(out_dir, exist_ok=True)
+  with open(labels_csv) as f:
+    rows = sorted((row['image'], int(row['level'])) for row in csv.DictReader(f))
+  # Fixed shuffle, so shards mix classes and patients and a resumed run assigns the same images to each shard
+  rows = [rows[i] for i in np.random.default_rng(seed).permutation(len(rows))]
+  extension = {os.path.splitext(name)[0]: name for name in os.listdir(image_dir)}
+  rows = [(os.path.join(image_dir, extension[image]), lab) for image, lab in rows if image in extension]
+
+  shards = {}
+  tasks = []
+  for i in range(0, len(rows), records_per_shard):
+    shard = 'shard-%05d.bin'%(i // records_per_shard)
+    sidecar = os.path.join(out_dir, shard + '.json')
+    if os.path.exists(sidecar):
+      with open(sidecar) as f:
+        shards[shard] = json.load(f)
+    else:
+      chunk = rows[i:i + records_per_shard]
+      tasks.append((shard, [path for path, _ in chunk], [lab for _, lab in chunk]))
+  print('Images: %d  Shards: %d (%d already built)'%(len(rows), len(shards) + len(tasks), len(shards)))
+
+  start = time.time()
+  with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+    futures = [executor.submit(build_shard, out_dir, shard, paths, labs, image_size) for shard, paths, labs in tasks]
+    for i, future in enumerate(concurrent.futures.as_completed(futures)):
+      info = future.result()
+      shards[info['file']] = info
+      print('\rBuilt shards: %d/%d (%.1f images/sec)'%(i + 1, len(tasks), (i + 1) * records_per_shard / (time.time() - start)), end='')
+  print()
+
+  shards = [shards[shard] for shard in sorted(shards)]
+  with open(manifest_path + '.tmp', 'w') as f:
+    json.dump({'image_size': list(image_size), 'record_bytes': 1 + image_size[0] * image_size[1] * 3,
+               'records': sum(shard['records'] for shard in shards), 'shards': shards}, f, indent=2)
+  failed = verify_image_shards(out_dir, manifest_path + '.tmp', n_workers)
+  if failed:
+    # Corrupted shards lose their sidecar and are rebuilt on the next run
+    for shard in failed:
+      os.remove(os.path.join(out_dir, shard + '.json'))
+    print('Checksum mismatch, rerun to rebuild: %s'%(', '.join(failed)))
+    return
+  os.rename(manifest_path + '.tmp', manifest_path)
+  print('Skipped unreadable images: %d'%(sum(len(shard['skipped']) for shard in shards)))
+
+def verify_image_shards(shards_dir, manifest_path=None, n_workers=None):
+  # Returns the shards whose size or sha256 does not match the manifest
+  with open(manifest_path or os.path.join(shards_dir, 'manifest.json')) as f:
+    manifest = json.load(f)
+  failed = [shard['file'] for shard in manifest['shards']
+            if os.path.getsize(os.path.join(shards_dir, shard['file'])) != shard['records'] * manifest['record_bytes']]
+  shards = [shard for shard in manifest['shards'] if 'sha256' in shard and shard['file'] not in failed]
+  with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+    digests = executor.map(file_sha256, [os.path.join(shards_dir, shard['file']) for shard in shards])
+    failed += [shard['file'] for shard, digest in zip(shards, digests) if digest != shard['sha256']]
+  return failed
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Build btgraham-300 image shards from raw images and their labels CSV (image,level)')
+  parser.add_argument('image_dir')
+  parser.add_argument('labels_csv')
+  parser.add_argument('out_dir')
+  parser.add_argument('--image-size', type=int, nargs=2, default=[512, 512], metavar=('HEIGHT', 'WIDTH'))
+  parser.add_argument('--records-per-shard', type=int, default=2048)
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--verify', action='store_true', help='only check an existing out_dir against its manifest')
+  args = parser.parse_args(argv)
+
+  if args.verify:
+    failed = verify_image_shards(args.out_dir, n_workers=args.workers)
+    print('Checksum mismatch: %s'%(', '.join(failed)) if failed else 'All shards verified')
+    return 1 if failed else 0
+  build_image_shards(args.image_dir, args.labels_csv, args.out_dir, tuple(args.image_size), args.records_per_shard,
+                     args.workers, args.seed)
+  return 0
+
+if __name__ == '__main__':
+  raise SystemExit(main())
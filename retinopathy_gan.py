@@ -0,0 +1,1597 @@
+# -*- coding: utf-8 -*-
+"""Library code of the BioInformatics Project notebook
+
+GANs and their training, feature extraction and caching, the linear regressors,
+the scoring service, benchmarks and evaluation. The notebook imports everything
+from here; the dataset preparation is in build_dataset.py and the batch scoring
+in score_images.py.
+"""
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+import numpy as np
+import time
+import os
+import json
+import hashlib
+import tempfile
+import shutil
+import collections
+import threading
+import queue
+import resource
+import subprocess
+import concurrent.futures
+import contextlib
+import http.server
+import urllib.request
+
+import joblib
+from joblib.externals.loky import ProcessPoolExecutor
+import scipy.linalg
+
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error
+
+class GAN(tf.keras.Model):
+    def __init__(self, discriminator, generator, latent_dim):
+        super(GAN, self).__init__()
+        self.latent_dim = latent_dim
+        self.discriminator = discriminator
+        self.generator = generator
+        # Created under the strategy scope, this gives every replica its own noise stream
+        self.noise_generator = tf.random.Generator.from_non_deterministic_state()
+        # See enable_stage_profiling; off, train_step traces exactly as before
+        self.profile_stages = False
+
+    def compile(self, d_optimizer, g_optimizer, loss_fn, jit_compile=False):
+        super(GAN, self).compile(jit_compile=jit_compile)
+        self.loss_fn = loss_fn
+        # float16 gradients need dynamic loss scaling to avoid underflow
+        self.loss_scaling = self.generator.layers[0].compute_dtype == 'float16'
+        if self.loss_scaling:
+          d_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(d_optimizer)
+          g_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(g_optimizer)
+        self.discriminator_optimizer = d_optimizer
+        self.generator_optimizer = g_optimizer
+
+    def average_loss(self, labels, logits, global_batch_size):
+        # loss_fn returns per-example losses (reduction NONE); dividing their sum
+        # by the global batch makes the replicas' summed gradients a batch mean
+        return tf.reduce_sum(self.loss_fn(labels, logits)) / global_batch_size
+
+    profile_stage_names = ['generator_forward', 'discriminator_forward', 'gradients', 'apply_gradients']
+
+    def timestamp(self, timestamps, *after):
+        # Device-side clock read ordered after the given tensors; a no-op unless profiling
+        if self.profile_stages:
+          with tf.control_dependencies([t for t in tf.nest.flatten(after) if t is not None]):
+            timestamps.append(tf.timestamp())
+
+    def train_step(self, data):
+        # Batches may carry their own noise, e.g. to compare runs across devices
+        if isinstance(data, tuple):
+          images, noise = data
+        else:
+          images = data
+          noise = self.noise_generator.normal([tf.shape(images)[0], self.latent_dim])
+        replica_context = tf.distribute.get_replica_context()
+        global_batch_size = replica_context.all_reduce(tf.distribute.ReduceOp.SUM, tf.cast(tf.shape(images)[0], tf.float32))
+        timestamps = []
+        self.timestamp(timestamps, images, noise)
+
+        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
+          generated_images = self.generator(noise, training=True)
+          self.timestamp(timestamps, generated_images)
+
+          real_output = self.discriminator(images, training=True)
+          fake_output = self.discriminator(generated_images, training=True)
+
+          gen_loss = self.average_loss(tf.ones_like(fake_output), fake_output, global_batch_size)
+
+          real_loss = self.average_loss(tf.ones_like(real_output), real_output, global_batch_size)
+          fake_loss = self.average_loss(tf.zeros_like(fake_output), fake_output, global_batch_size)
+          disc_loss = real_loss + fake_loss
+          self.timestamp(timestamps, gen_loss, disc_loss)
+
+          if self.loss_scaling:
+            scaled_gen_loss = self.generator_optimizer.get_scaled_loss(gen_loss)
+            scaled_disc_loss = self.discriminator_optimizer.get_scaled_loss(disc_loss)
+          else:
+            scaled_gen_loss, scaled_disc_loss = gen_loss, disc_loss
+
+        gradients_of_generator = gen_tape.gradient(scaled_gen_loss, self.generator.trainable_variables)
+        gradients_of_discriminator = disc_tape.gradient(scaled_disc_loss, self.discriminator.trainable_variables)
+        if self.loss_scaling:
+          gradients_of_generator = self.generator_optimizer.get_unscaled_gradients(gradients_of_generator)
+          gradients_of_discriminator = self.discriminator_optimizer.get_unscaled_gradients(gradients_of_discriminator)
+        self.timestamp(timestamps, gradients_of_generator, gradients_of_discriminator)
+
+        self.generator_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
+        self.discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
+        # Stateful ops keep program order in a tf.function, so this follows the variable updates
+        self.timestamp(timestamps)
+        logs = {"d_loss": replica_context.all_reduce(tf.distribute.ReduceOp.SUM, disc_loss),
+                "g_loss": replica_context.all_reduce(tf.distribute.ReduceOp.SUM, gen_loss)}
+        for name, start, end in zip(self.profile_stage_names, timestamps[:-1], timestamps[1:]):
+          logs['stage/' + name] = replica_context.all_reduce(tf.distribute.ReduceOp.MEAN, tf.cast(end - start, tf.float32))
+        return logs
+
+def build_discriminator():
+  # The output layer stays float32 so logits and losses are full precision under a mixed policy
+  return tf.keras.Sequential(
+      [
+          tf.keras.layers.InputLayer((512, 512, 3)),
+
+          tf.keras.layers.Conv2D(32, (4, 4), strides=(2, 2), padding='same'),
+          tf.keras.layers.LeakyReLU(),
+          tf.keras.layers.Dropout(0.3),
+
+          tf.keras.layers.Conv2D(64, (4, 4), strides=(2, 2), padding='same'),
+          tf.keras.layers.LeakyReLU(),
+          tf.keras.layers.Dropout(0.3),
+      
+          tf.keras.layers.Conv2D(128, (4, 4), strides=(2, 2), padding='same'),
+          tf.keras.layers.LeakyReLU(),
+          tf.keras.layers.Dropout(0.3),
+      
+          tf.keras.layers.Conv2D(256, (4, 4), strides=(2, 2), padding='same'),
+          tf.keras.layers.LeakyReLU(),
+          tf.keras.layers.Dropout(0.3),
+      
+          tf.keras.layers.Conv2D(512, (4, 4), strides=(2, 2), padding='same'),
+          tf.keras.layers.LeakyReLU(),
+          tf.keras.layers.Dropout(0.3),
+
+          tf.keras.layers.Flatten(),
+          tf.keras.layers.Dense(1, dtype='float32'),
+      ],
+      name="discriminator",
+  )
+
+def build_generator(early_stride, late_stride, latent_dim=100, sync_batchnorm=False):
+  # Across replicas, synchronized batch statistics keep training equivalent to a single device
+  batch_norm = tf.keras.layers.experimental.SyncBatchNormalization if sync_batchnorm else tf.keras.layers.BatchNormalization
+  return tf.keras.Sequential(
+      [
+          tf.keras.layers.InputLayer(latent_dim),
+          tf.keras.layers.Dense(128 * 128 * 128, use_bias=False, input_shape=(100,)),
+          batch_norm(),
+          tf.keras.layers.LeakyReLU(),
+
+          tf.keras.layers.Reshape((128, 128, 128)),
+          tf.keras.layers.Conv2DTranspose(64, (4, 4), strides=early_stride, padding='same', use_bias=False),
+          batch_norm(),
+          tf.keras.layers.LeakyReLU(),
+
+          tf.keras.layers.Conv2DTranspose(32, (4, 4), strides=(2, 2), padding='same', use_bias=False),
+          batch_norm(),
+          tf.keras.layers.LeakyReLU(),
+
+          tf.keras.layers.Conv2DTranspose(3, (4, 4), strides=late_stride, padding='same', use_bias=False, activation='sigmoid', dtype='float32'),
+      ],
+      name="generator",
+  )
+
+def build_progressive_generator(latent_dim=100, sync_batchnorm=False):
+  # Starts from a 4x4x512 seed (~0.8M stem weights instead of ~210M) and
+  # doubles the resolution seven times up to 512x512
+  batch_norm = tf.keras.layers.experimental.SyncBatchNormalization if sync_batchnorm else tf.keras.layers.BatchNormalization
+  layers = [
+      tf.keras.layers.InputLayer(latent_dim),
+      tf.keras.layers.Dense(4 * 4 * 512, use_bias=False),
+      batch_norm(),
+      tf.keras.layers.LeakyReLU(),
+      tf.keras.layers.Reshape((4, 4, 512)),
+  ]
+  for filters in [512, 256, 128, 128, 64, 32]:
+    layers += [
+        tf.keras.layers.Conv2DTranspose(filters, (4, 4), strides=(2, 2), padding='same', use_bias=False),
+        batch_norm(),
+        tf.keras.layers.LeakyReLU(),
+    ]
+  layers.append(tf.keras.layers.Conv2DTranspose(3, (4, 4), strides=(2, 2), padding='same', use_bias=False, activation='sigmoid', dtype='float32'))
+  return tf.keras.Sequential(layers, name="generator")
+
+def gan_config(ver):
+  if ver == 1:
+    early_stride = (1,1)
+    late_stride = (2,2)
+    ckpts_path = '/content/gdrive/My Drive/normal_gan_ckpts'
+    lr = 0.0001
+  elif ver == 2:
+    early_stride = (2,2)
+    late_stride = (1,1)
+    ckpts_path = '/content/gdrive/My Drive/deep_aug_dims_ckpts'
+    lr = 0.00001
+  else:
+    print("Wrong version index")
+    return
+  return early_stride, late_stride, ckpts_path, lr
+
+def build_gan(ver, jit_compile=False, mixed_precision=None, strategy=None, generator_arch='dense'):
+  config = gan_config(ver)
+  if config is None:
+    return
+  early_stride, late_stride, ckpts_path, lr = config
+
+  # mixed_precision is a Keras policy name, e.g. 'mixed_float16' (GPU) or 'mixed_bfloat16' (CPU/TPU)
+  if strategy is None:
+    strategy = tf.distribute.get_strategy()
+  policy = tf.keras.mixed_precision.global_policy()
+  if mixed_precision is not None:
+    tf.keras.mixed_precision.set_global_policy(mixed_precision)
+  try:
+    with strategy.scope():
+      discriminator = build_discriminator()
+      latent_dim = 100
+      if generator_arch == 'dense':
+        generator = build_generator(early_stride, late_stride, latent_dim, sync_batchnorm=strategy.num_replicas_in_sync > 1)
+      else:
+        generator = build_progressive_generator(latent_dim, sync_batchnorm=strategy.num_replicas_in_sync > 1)
+  finally:
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+  with strategy.scope():
+    gan = GAN(discriminator=discriminator, generator=generator, latent_dim=latent_dim)
+    gan.compile(
+        d_optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
+        g_optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
+        loss_fn=tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE),
+        jit_compile=jit_compile,
+    )
+  # The progressive generator's weights are not compatible with the original checkpoints
+  gan.ckpts_path = ckpts_path if generator_arch == 'dense' else ckpts_path + '_' + generator_arch
+  return gan
+
+def restore_gan(ver, jit_compile=False, mixed_precision=None, strategy=None, generator_arch='dense'):
+  gan = build_gan(ver, jit_compile, mixed_precision, strategy, generator_arch)
+  if gan is None:
+    return
+  checkpoint = tf.train.Checkpoint(gan)
+  checkpoint_path = tf.train.latest_checkpoint(gan.ckpts_path)
+  checkpoint.restore(checkpoint_path)
+  gan.discriminator.checkpoint_path = checkpoint_path
+  return gan
+
+def restore_discriminator(ver, ckpts_path=None):
+  # Builds only the discriminator and reads only its variables from the GAN
+  # checkpoint; the generator, both optimizers and their slots are skipped.
+  # ckpts_path overrides the checkpoint directory of the version
+  config = gan_config(ver)
+  if config is None:
+    return
+  discriminator = build_discriminator()
+  checkpoint_path = tf.train.latest_checkpoint(ckpts_path or config[2])
+  tf.train.Checkpoint(discriminator=discriminator).restore(checkpoint_path).expect_partial()
+  discriminator.checkpoint_path = checkpoint_path
+  return discriminator
+
+def measure_restore(ver, mode):
+  start = time.time()
+  if mode == 'gan':
+    discriminator = restore_gan(ver).discriminator
+  else:
+    discriminator = restore_discriminator(ver)
+  create_extractor(discriminator)(tf.zeros([1, 512, 512, 3]))
+  return {'mode': mode, 'cold_start': time.time() - start,
+          'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def benchmark_restore(ver):
+  # Each mode runs in a fresh worker process, as a scoring job would
+  results = []
+  for mode in ['gan', 'discriminator']:
+    with ProcessPoolExecutor(max_workers=1) as executor:
+      results.append(executor.submit(measure_restore, ver, mode).result())
+  return results
+
+class StageProfiler:
+    # Wall-clock spans per named stage, also visible as annotations in a TensorBoard
+    # profile; a disabled profiler hands out one shared no-op context
+    null_stage = contextlib.nullcontext()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+          return self.null_stage
+        return self.timed_stage(name)
+
+    @contextlib.contextmanager
+    def timed_stage(self, name):
+        with tf.profiler.experimental.Trace(name):
+          start = time.perf_counter()
+          try:
+            yield
+          finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end):
+        with self.lock:
+          self.events.append((name, start, end, threading.get_ident()))
+
+    def summary(self):
+        stages = collections.defaultdict(list)
+        for name, start, end, _ in self.events:
+          stages[name].append(end - start)
+        total = sum(sum(durations) for durations in stages.values())
+        rows = {}
+        print('%-32s %7s %10s %10s %10s %7s'%('stage', 'count', 'total s', 'mean ms', 'p99 ms', 'share'))
+        for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+          durations = np.array(durations)
+          rows[name] = {'count': len(durations), 'total': float(durations.sum()), 'mean_ms': float(durations.mean() * 1000),
+                        'p99_ms': float(np.percentile(durations, 99) * 1000), 'share': float(durations.sum() / total)}
+          print('%-32s %7d %10.3f %10.2f %10.2f %6.1f%%'%(name, rows[name]['count'], rows[name]['total'], rows[name]['mean_ms'],
+                                                        rows[name]['p99_ms'], rows[name]['share'] * 100))
+        return rows
+
+    def export_chrome_trace(self, path):
+        # Opens in chrome://tracing or Perfetto
+        with self.lock:
+          events = list(self.events)
+        origin = min((start for _, start, _, _ in events), default=0)
+        with open(path, 'w') as f:
+          json.dump({'traceEvents': [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                                      'ts': (start - origin) * 1e6, 'dur': (end - start) * 1e6}
+                                     for name, start, end, tid in events]}, f)
+        return path
+
+no_profiler = StageProfiler(enabled=False)
+
+class TrainStepProfiler(tf.keras.callbacks.Callback):
+  # Lays the device-timed train_step stages out inside each step's host span;
+  # the rest of the step (input pipeline, dispatch, all-reduce) is 'train_step/other'
+  def __init__(self, profiler):
+    super(TrainStepProfiler, self).__init__()
+    self.profiler = profiler
+
+  def on_train_batch_begin(self, batch, logs=None):
+    self.start = time.perf_counter()
+
+  def on_train_batch_end(self, batch, logs=None):
+    end = time.perf_counter()
+    t = self.start
+    for name in GAN.profile_stage_names:
+      if 'stage/' + name in logs:
+        duration = float(logs['stage/' + name])
+        self.profiler.record('train_step/' + name, t, t + duration)
+        t += duration
+    self.profiler.record('train_step/other', t, max(t, end))
+
+def enable_stage_profiling(gan, enabled=True):
+  if enabled and getattr(gan, 'jit_compile', False):
+    print('Stage timestamps cannot be compiled with XLA: build the GAN with jit_compile=False to profile it')
+    return
+  gan.profile_stages = enabled
+  # Retraced with or without the timestamps on the next fit
+  gan.train_function = None
+
+def profile_train_step(gan, profiler, batch_size=4, steps=10):
+  enable_stage_profiling(gan)
+  images = tf.random.uniform([batch_size, 512, 512, 3])
+  # The first step pays for tracing and is left out
+  gan.fit(tf.data.Dataset.from_tensors(images).repeat(1), epochs=1, verbose=0)
+  gan.fit(tf.data.Dataset.from_tensors(images).repeat(steps), epochs=1, verbose=0, callbacks=[TrainStepProfiler(profiler)])
+  enable_stage_profiling(gan, False)
+
+class StepTimer(tf.keras.callbacks.Callback):
+  def __init__(self):
+    super(StepTimer, self).__init__()
+    self.times = []
+
+  def on_train_batch_begin(self, batch, logs=None):
+    self.start = time.time()
+
+  def on_train_batch_end(self, batch, logs=None):
+    self.times.append(time.time() - self.start)
+
+def time_train_step(gan, batch_size=4, steps=5):
+  images = tf.random.uniform([batch_size, 512, 512, 3])
+  timer = StepTimer()
+  gan.fit(tf.data.Dataset.from_tensors(images).repeat(steps + 1), epochs=1, verbose=0, callbacks=[timer])
+  # The first step pays for tracing and, with jit_compile, XLA compilation
+  return np.median(timer.times[1:])
+
+def measure_generator(ver, generator_arch, batch_size=4, steps=5):
+  gan = build_gan(ver, generator_arch=generator_arch)
+  step_time = time_train_step(gan, batch_size, steps)
+  tmp = tempfile.mkdtemp()
+  try:
+    tf.train.Checkpoint(gan).write(os.path.join(tmp, 'ckpt'))
+    checkpoint_bytes = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+  finally:
+    shutil.rmtree(tmp)
+  return {
+      'generator_arch': generator_arch,
+      'generator_params': gan.generator.count_params(),
+      'checkpoint_mb': checkpoint_bytes / 2**20,
+      'step_time': step_time,
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+
+def benchmark_generators(ver, batch_size=4, steps=5):
+  # Each architecture is measured in a fresh worker process so peak RSS is not shared
+  results = []
+  for generator_arch in ['dense', 'progressive']:
+    with ProcessPoolExecutor(max_workers=1) as executor:
+      results.append(executor.submit(measure_generator, ver, generator_arch, batch_size, steps).result())
+  return results
+
+def async_checkpoint_options():
+  # Variables are copied to host memory and written by a background thread,
+  # so training only stalls for the copy; older TensorFlow writes synchronously
+  for option in ['enable_async', 'experimental_enable_async_checkpoint']:
+    try:
+      return tf.train.CheckpointOptions(**{option: True})
+    except TypeError:
+      pass
+  return tf.train.CheckpointOptions()
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+  def __init__(self, manager, every_n_steps=None, every_secs=600):
+    super(CheckpointCallback, self).__init__()
+    self.manager = manager
+    self.every_n_steps = every_n_steps
+    self.every_secs = every_secs
+    self.options = async_checkpoint_options()
+
+  def on_train_begin(self, logs=None):
+    self.last_step = int(self.model.generator_optimizer.iterations)
+    self.last_time = time.time()
+
+  def on_train_batch_end(self, batch, logs=None):
+    step = int(self.model.generator_optimizer.iterations)
+    if ((self.every_n_steps is not None and step - self.last_step >= self.every_n_steps) or
+        (self.every_secs is not None and time.time() - self.last_time >= self.every_secs)):
+      self.save(step)
+
+  def on_train_end(self, logs=None):
+    step = int(self.model.generator_optimizer.iterations)
+    if step != self.last_step:
+      self.save(step)
+    # Wait for the background write of the last checkpoint
+    if hasattr(self.manager.checkpoint, 'sync'):
+      self.manager.checkpoint.sync()
+    # Extractors built from the trained discriminator are cached under these weights, not the restored ones
+    self.model.discriminator.checkpoint_path = self.manager.latest_checkpoint
+
+  def save(self, step):
+    self.manager.save(checkpoint_number=step, options=self.options)
+    self.last_step = step
+    self.last_time = time.time()
+
+def image_grid(images, cols):
+  n, h, w, c = images.shape
+  rows = -(-n // cols)
+  images = np.concatenate([images, np.zeros((rows * cols - n, h, w, c), images.dtype)])
+  return images.reshape(rows, cols, h, w, c).transpose(0, 2, 1, 3, 4).reshape(rows * h, cols * w, c)
+
+class PreviewCallback(tf.keras.callbacks.Callback):
+  # Renders a fixed-noise sample grid every `every` epochs and appends the
+  # losses to a JSON-lines event log; grids are encoded and written by a
+  # background thread so training never waits on them
+  def __init__(self, out_dir, every=5, n_images=16, cols=4, seed=0, log_every_steps=None):
+    super(PreviewCallback, self).__init__()
+    self.out_dir = out_dir
+    self.every = every
+    self.n_images = n_images
+    self.cols = cols
+    self.seed = seed
+    self.log_every_steps = log_every_steps
+    self.queue = queue.Queue(maxsize=2)
+
+  def on_train_begin(self, logs=None):
+    os.makedirs(self.out_dir, exist_ok=True)
+    self.noise = tf.random.Generator.from_seed(self.seed).normal([self.n_images, self.model.latent_dim])
+    self.events = open(os.path.join(self.out_dir, 'events.jsonl'), 'a')
+    self.worker = threading.Thread(target=self.render, daemon=True)
+    self.worker.start()
+
+  def on_train_batch_end(self, batch, logs=None):
+    if self.log_every_steps is not None and (batch + 1) % self.log_every_steps == 0:
+      self.log_event({'step': int(self.model.generator_optimizer.iterations)}, logs)
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.log_event({'epoch': epoch + 1}, logs)
+    if (epoch + 1) % self.every == 0:
+      images = tf.image.convert_image_dtype(self.model.generator(self.noise, training=False), tf.uint8, saturate=True)
+      try:
+        self.queue.put_nowait((epoch + 1, images.numpy()))
+      except queue.Full:
+        print('\nPreview writer is behind, skipping epoch %d'%(epoch + 1))
+
+  def on_train_end(self, logs=None):
+    self.queue.put(None)
+    self.worker.join()
+    self.events.close()
+
+  def log_event(self, event, logs):
+    event['time'] = time.time()
+    event.update({k: float(v) for k, v in (logs or {}).items()})
+    self.events.write(json.dumps(event) + '\n')
+    self.events.flush()
+
+  def render(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      epoch, images = item
+      png = tf.io.encode_png(image_grid(images, self.cols))
+      tf.io.write_file(os.path.join(self.out_dir, 'epoch-%04d.png'%(epoch)), png)
+
+def restore_latest_valid(checkpoint, manager):
+  for checkpoint_path in reversed(manager.checkpoints):
+    try:
+      checkpoint.restore(checkpoint_path)
+      return checkpoint_path
+    except (tf.errors.OpError, ValueError) as e:
+      print('Skipping unreadable checkpoint %s: %s'%(checkpoint_path, e))
+  return None
+
+def train_gan(ver, dataset, epochs, strategy=None, callbacks=None, jit_compile=False, mixed_precision=None,
+              checkpoint_every_steps=None, checkpoint_every_secs=600, generator_arch='dense'):
+  # With a strategy, the model is built in its scope and fit splits every
+  # (global) batch of the dataset across the replicas
+  gan = build_gan(ver, jit_compile, mixed_precision, strategy, generator_arch)
+  checkpoint = tf.train.Checkpoint(gan)
+  manager = tf.train.CheckpointManager(checkpoint, gan.ckpts_path, max_to_keep=2)
+  gan.discriminator.checkpoint_path = restore_latest_valid(checkpoint, manager)
+  callbacks = list(callbacks or []) + [CheckpointCallback(manager, checkpoint_every_steps, checkpoint_every_secs)]
+
+  # The optimizer step counter is part of the checkpoint and gives the epoch and
+  # the number of batches already seen in it. dataset is either a tf.data.Dataset
+  # with a fixed order, or a function epoch -> dataset (e.g. shuffled with a
+  # per-epoch seed): either way the skipped batches are exactly the ones trained on
+  make_dataset = dataset if callable(dataset) else lambda epoch: dataset
+  initial_epoch, skip = divmod(int(gan.generator_optimizer.iterations), len(make_dataset(0)))
+  for epoch in range(initial_epoch, epochs):
+    epoch_dataset = make_dataset(epoch)
+    if epoch == initial_epoch and skip:
+      epoch_dataset = epoch_dataset.skip(skip)
+    gan.fit(epoch_dataset, epochs=epoch + 1, initial_epoch=epoch, callbacks=callbacks)
+  return gan
+
+def make_cpu_strategy(n_devices=2):
+  # Splits the host CPU into logical devices; must run before TensorFlow initializes them
+  cpus = tf.config.list_physical_devices('CPU')
+  tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration()] * n_devices)
+  return tf.distribute.MirroredStrategy(['/cpu:%d'%(i) for i in range(n_devices)])
+
+def check_distributed_parity(ver, strategy, batch_size=4):
+  # One step on the same images, noise and initial weights, with dropout disabled
+  # so both runs are deterministic; returns the largest weight and loss differences
+  images = tf.random.uniform([batch_size, 512, 512, 3], seed=0)
+  noise = tf.random.normal([batch_size, 100], seed=1)
+  single = build_gan(ver)
+  distributed = build_gan(ver, strategy=strategy)
+  distributed.discriminator.set_weights(single.discriminator.get_weights())
+  distributed.generator.set_weights(single.generator.get_weights())
+  for gan in [single, distributed]:
+    for layer in gan.discriminator.layers:
+      if isinstance(layer, tf.keras.layers.Dropout):
+        layer.rate = 0.0
+
+  ds = tf.data.Dataset.from_tensors((images, noise))
+  single_logs = single.fit(ds, epochs=1, verbose=0).history
+  distributed_logs = distributed.fit(ds, epochs=1, verbose=0).history
+  weight_diff = max(np.max(np.abs(a - b)) for a, b in zip(single.discriminator.get_weights() + single.generator.get_weights(),
+                                                            distributed.discriminator.get_weights() + distributed.generator.get_weights()))
+  loss_diff = max(abs(single_logs[k][0] - distributed_logs[k][0]) for k in single_logs)
+  return weight_diff, loss_diff
+
+def generate_images(gan, n_images, out_dir, batch_size=64, seed=0, image_format='png', images_per_shard=1000,
+                    num_workers=8, max_pending=4):
+  # Generator inference runs on this thread while a pool encodes and writes
+  # earlier batches; at most max_pending batches are held in memory
+  ext = 'png' if image_format == 'png' else 'jpeg'
+  encode = tf.io.encode_png if image_format == 'png' else lambda image: tf.io.encode_jpeg(image, quality=95)
+  noise_generator = tf.random.Generator.from_seed(seed)
+  generate = tf.function(lambda noise: tf.image.convert_image_dtype(gan.generator(noise, training=False), tf.uint8, saturate=True))
+
+  def write_batch(start, images):
+    rows = []
+    for k, image in enumerate(images):
+      index = start + k
+      shard = 'shard-%05d'%(index // images_per_shard)
+      os.makedirs(os.path.join(out_dir, shard), exist_ok=True)
+      filename = '%s/%08d.%s'%(shard, index, ext)
+      tf.io.write_file(os.path.join(out_dir, filename), encode(image))
+      rows.append('%s,%d,%s\n'%(filename, index, shard))
+    return rows
+
+  os.makedirs(out_dir, exist_ok=True)
+  start = time.time()
+  with open(os.path.join(out_dir, 'manifest.csv'), 'w') as manifest, \
+       concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+    manifest.write('# seed=%d batch_size=%d latent_dim=%d\nfilename,index,shard\n'%(seed, batch_size, gan.latent_dim))
+    pending = collections.deque()
+    for i in range(0, n_images, batch_size):
+      noise = noise_generator.normal([min(batch_size, n_images - i), gan.latent_dim])
+      pending.append(pool.submit(write_batch, i, generate(noise).numpy()))
+      while len(pending) > max_pending or (pending and pending[0].done()):
+        manifest.writelines(pending.popleft().result())
+      print('\rGenerated images: %d/%d (%.1f images/sec)'%(min(i + batch_size, n_images), n_images, (i + batch_size)/(time.time() - start)), end='')
+    while pending:
+      manifest.writelines(pending.popleft().result())
+  print()
+
+def create_extractor(discriminator, cut_layer=-3, image_size=(512, 512)):
+  # The truncated discriminator is fully convolutional: image_size=None accepts any resolution
+  shape = (None, None, 3) if image_size is None else (image_size[0], image_size[1], 3)
+  # The discriminator's layers are re-applied to an input of the requested size (sharing
+  # their weights), since its own graph only accepts 512x512 images
+  x = extractor_input = tf.keras.layers.Input(shape=shape)
+  for layer in discriminator.layers[:cut_layer % len(discriminator.layers) + 1]:
+    x = layer(x)
+  extractor = tf.keras.models.Model(extractor_input, x)
+  extractor.trainable = False
+  input = tf.keras.layers.Input(shape=shape)
+  x = extractor(input)
+  x = tf.keras.layers.GlobalAveragePooling2D()(x)
+  model = tf.keras.models.Model(input, x)
+  model.cut_layer = cut_layer % len(discriminator.layers)
+  model.checkpoint_path = getattr(discriminator, 'checkpoint_path', None)
+  return model
+
+def preprocess_sample(sample, image_size=(512, 512)):
+  # image_size=None keeps the native resolution
+  image = tf.image.convert_image_dtype(sample['image'], dtype=tf.float32)
+  if image_size is not None:
+    image = tf.image.resize(image, image_size)
+  return image, tf.cast(sample['label'], tf.float32)
+
+def write_image_shards(ds, out_dir, image_size=(512, 512), records_per_shard=2048):
+  # Fixed-size records (1 label byte followed by the uint8 HxWx3 pixels), so a
+  # shard can be read with FixedLengthRecordDataset or np.memmap alike
+  manifest_path = os.path.join(out_dir, 'manifest.json')
+  if os.path.exists(manifest_path):
+    print('Shards already written to %s'%(out_dir))
+    return
+  os.makedirs(out_dir, exist_ok=True)
+  ds = ds.map(lambda sample: (tf.image.convert_image_dtype(preprocess_sample(sample, image_size)[0], tf.uint8, saturate=True),
+                              tf.cast(sample['label'], tf.uint8)), num_parallel_calls=tf.data.AUTOTUNE)
+  ds = ds.batch(64).prefetch(tf.data.AUTOTUNE)
+
+  shards = []
+  f = None
+  n_records = 0
+  for images, labs in ds:
+    for image, lab in zip(images.numpy(), labs.numpy()):
+      if f is None or shards[-1]['records'] == records_per_shard:
+        if f is not None: f.close()
+        shards.append({'file': 'shard-%05d.bin'%(len(shards)), 'records': 0})
+        f = open(os.path.join(out_dir, shards[-1]['file']), 'wb')
+      f.write(lab.tobytes())
+      f.write(image.tobytes())
+      shards[-1]['records'] += 1
+      n_records += 1
+    print('\rWritten records: %d'%(n_records), end='')
+  if f is not None: f.close()
+  print()
+
+  # The manifest is written last and marks the conversion as complete
+  with open(manifest_path, 'w') as f:
+    json.dump({'image_size': list(image_size), 'record_bytes': 1 + image_size[0] * image_size[1] * 3,
+               'records': n_records, 'shards': shards}, f, indent=2)
+
+def image_shards_record_dtype(image_size):
+  return np.dtype([('label', np.uint8), ('image', np.uint8, (image_size[0], image_size[1], 3))])
+
+def load_image_shards(shards_dir, shuffle_files=False, seed=None):
+  # With a seed the shuffled file order (and the records within it) is reproducible
+  with open(os.path.join(shards_dir, 'manifest.json')) as f:
+    manifest = json.load(f)
+  height, width = manifest['image_size']
+  files = [os.path.join(shards_dir, shard['file']) for shard in manifest['shards']]
+
+  ds = tf.data.Dataset.from_tensor_slices(files)
+  if shuffle_files:
+    ds = ds.shuffle(len(files), seed=seed, reshuffle_each_iteration=seed is None)
+  ds = ds.interleave(lambda f: tf.data.FixedLengthRecordDataset(f, manifest['record_bytes']),
+                     num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle_files or seed is not None)
+
+  def decode(record):
+    record = tf.io.decode_raw(record, tf.uint8)
+    image = tf.image.convert_image_dtype(tf.reshape(record[1:], [height, width, 3]), dtype=tf.float32)
+    return image, tf.cast(record[0], tf.float32)
+
+  ds = ds.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+  return ds.apply(tf.data.experimental.assert_cardinality(manifest['records']))
+
+def extract_split(extractors, ds, name, batch_size=32, image_size=(512, 512), profiler=no_profiler,
+                  outputs=None, offset=0, on_progress=None, progress_every=50):
+  # outputs: preallocated (features, labels) arrays, e.g. memory-mapped, filled from row
+  # offset on; on_progress(rows_done) is called every progress_every batches and at the end
+  n_samples = offset + len(ds)
+  # Pre-decoded shards already yield (image, label) pairs at the target size
+  if isinstance(ds.element_spec, dict):
+    ds = ds.map(lambda sample: preprocess_sample(sample, image_size), num_parallel_calls=tf.data.AUTOTUNE)
+  if image_size is None:
+    # At native resolution only images of the same size can share a batch
+    ds = ds.group_by_window(key_func=lambda image, label: tf.cast(tf.shape(image)[0] * 65536 + tf.shape(image)[1], tf.int64),
+                            reduce_func=lambda key, window: window.batch(batch_size), window_size=batch_size)
+  else:
+    ds = ds.batch(batch_size)
+  ds = ds.prefetch(tf.data.AUTOTUNE)
+  # Every extractor sees the same decoded batch; a single trace serves every
+  # batch, including the last partial one
+  forward = tf.function(lambda images: [extractor(images, training=False) for extractor in extractors],
+                        input_signature=[tf.TensorSpec([None, None, None, 3], tf.float32)])
+
+  if outputs is None:
+    features = [np.zeros((n_samples, extractor.output.shape[-1]), dtype=np.float32) for extractor in extractors]
+    labels = np.zeros(n_samples, dtype=np.float32)
+  else:
+    features, labels = outputs
+  start = time.time()
+  i = offset
+  n_batches = 0
+  iterator = iter(ds)
+  while True:
+    # 'input' is the wait on the fused read/decode/resize pipeline, and on a GPU 'copy_back'
+    # also absorbs the asynchronous forward pass; profile_extraction separates them
+    with profiler.stage('extract/input'):
+      batch = next(iterator, None)
+    if batch is None:
+      break
+    images, labs = batch
+    j = i + labs.shape[0]
+    with profiler.stage('extract/forward'):
+      outputs = forward(images)
+    with profiler.stage('extract/copy_back'):
+      for feats, out in zip(features, outputs):
+        feats[i:j] = out.numpy()
+    labels[i:j] = labs.numpy()
+    i = j
+    n_batches += 1
+    if on_progress is not None and n_batches % progress_every == 0:
+      on_progress(i)
+    print('\r%s Dataset to list: %.0f%% (%.1f images/sec)'%(name, (i/n_samples)*100, (i - offset)/(time.time() - start)), end='')
+  print()
+  if on_progress is not None:
+    on_progress(i)
+  return features, labels
+
+def profile_extraction(extractor, profiler, split='train', n_batches=20, batch_size=32, image_size=(512, 512)):
+  # The same work as extract_split, run stage by stage and eagerly so each one can
+  # be timed on its own; slower overall, for finding the bottleneck only
+  dir = "/content/gdrive/MyDrive/dataset"
+  ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", split=split, data_dir=dir,
+                 decoders={'image': tfds.decode.SkipDecoding()})
+  iterator = iter(ds)
+  device = '/GPU:0' if tf.config.list_logical_devices('GPU') else '/CPU:0'
+  forward = tf.function(lambda images: extractor(images, training=False),
+                        input_signature=[tf.TensorSpec([None, image_size[0], image_size[1], 3], tf.float32)])
+  forward(tf.zeros([1, image_size[0], image_size[1], 3]))
+
+  for _ in range(n_batches):
+    with profiler.stage('read'):
+      samples = [sample for _, sample in zip(range(batch_size), iterator)]
+    if not samples:
+      break
+    with profiler.stage('decode'):
+      images = [tf.io.decode_image(sample['image'], channels=3, expand_animations=False) for sample in samples]
+    with profiler.stage('resize'):
+      images = np.stack([tf.image.resize(tf.image.convert_image_dtype(image, tf.float32), image_size).numpy() for image in images])
+    with profiler.stage('host_to_device'):
+      with tf.device(device):
+        images = tf.identity(images)
+      # Reading one element waits for the whole tensor to be in place
+      images[0, 0, 0, 0].numpy()
+    with profiler.stage('forward'):
+      feats = forward(images)
+      feats[0, 0].numpy()
+    with profiler.stage('copy_back'):
+      feats.numpy()
+
+def checkpoint_fingerprint(checkpoint_path):
+  # The .index file stores a crc32c for every saved tensor, so hashing it
+  # covers the weights without reading the (large) data shards
+  fingerprint = hashlib.sha1(os.path.basename(checkpoint_path).encode())
+  with tf.io.gfile.GFile(checkpoint_path + '.index', 'rb') as f:
+    fingerprint.update(f.read())
+  return fingerprint.hexdigest()
+
+def feature_cache_entry(cache_dir, extractor, info, split, image_size, shards_dir=None, dtype=np.float32):
+  if cache_dir is None or getattr(extractor, 'checkpoint_path', None) is None:
+    return None
+  config = {
+      'checkpoint': checkpoint_fingerprint(extractor.checkpoint_path),
+      'dataset': info.full_name,
+      'version': str(info.version),
+      'split': split,
+      'image_size': 'native' if image_size is None else list(image_size),
+      'source': 'tfds' if shards_dir is None else 'shards',
+      'cut_layer': extractor.cut_layer,
+  }
+  if shards_dir is not None:
+    # Shards written from tfds and built from raw images share the format (and directory),
+    # so the key follows their manifest rather than the tfds version
+    with open(os.path.join(shards_dir, 'manifest.json'), 'rb') as f:
+      config['shards'] = {'dir': os.path.abspath(shards_dir), 'manifest': hashlib.sha1(f.read()).hexdigest()}
+  if np.dtype(dtype) != np.float32:
+    config['dtype'] = np.dtype(dtype).name
+  key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+  return os.path.join(cache_dir, '%s-%s'%(split, key)), config
+
+def load_cached_features(entry):
+  return np.load(os.path.join(entry, 'features.npy'), mmap_mode='r'), np.load(os.path.join(entry, 'labels.npy'), mmap_mode='r')
+
+def open_partial_features(entry, n_samples, n_features, dtype=np.float32):
+  # Preallocated .npy files next to the cache entry, filled in place; progress.json
+  # holds the rows known to be on disk, so an interrupted extraction resumes from there
+  partial = entry + '.partial'
+  progress_path = os.path.join(partial, 'progress.json')
+  if os.path.exists(progress_path):
+    with open(progress_path) as f:
+      done = json.load(f)['done']
+    mode = 'r+'
+  else:
+    os.makedirs(partial, exist_ok=True)
+    done = 0
+    mode = 'w+'
+  features = np.lib.format.open_memmap(os.path.join(partial, 'features.npy'), mode=mode, dtype=dtype, shape=(n_samples, n_features))
+  labels = np.lib.format.open_memmap(os.path.join(partial, 'labels.npy'), mode=mode, dtype=np.float32, shape=(n_samples,))
+  return features, labels, done
+
+def commit_partial_features(entry, features, labels, done, config=None):
+  # Rows are flushed before the progress is recorded; with a config the entry is complete and published
+  partial = entry + '.partial'
+  features.flush()
+  labels.flush()
+  progress_path = os.path.join(partial, 'progress.json')
+  with open(progress_path + '.tmp', 'w') as f:
+    json.dump({'done': done}, f)
+  os.replace(progress_path + '.tmp', progress_path)
+  if config is not None:
+    with open(os.path.join(partial, 'config.json'), 'w') as f:
+      json.dump(config, f, indent=2)
+    os.remove(progress_path)
+    os.rename(partial, entry)
+
+def iter_feature_chunks(features, labels=None, chunk_size=8192, dtype=np.float32):
+  # Bounded-memory reads of a (memory-mapped) feature matrix
+  for i in range(0, len(features), chunk_size):
+    chunk = np.asarray(features[i:i + chunk_size], dtype=dtype)
+    yield chunk if labels is None else (chunk, np.asarray(labels[i:i + chunk_size]))
+
+def npy_file(features):
+  # The .npy file behind a memory-mapped array, when the array is that whole file
+  if isinstance(features, np.memmap) and isinstance(features.filename, str) and features.filename.endswith('.npy'):
+    whole = np.load(features.filename, mmap_mode='r')
+    if whole.shape == features.shape and whole.dtype == features.dtype and whole.offset == features.offset:
+      return features.filename
+  return None
+
+def save_cached_features(entry, config, features, labels):
+  # Write next to the entry and rename, so an interrupted run never leaves a half-written hit
+  tmp = '%s.tmp-%d'%(entry, os.getpid())
+  os.makedirs(tmp, exist_ok=True)
+  np.save(os.path.join(tmp, 'features.npy'), features)
+  np.save(os.path.join(tmp, 'labels.npy'), labels)
+  with open(os.path.join(tmp, 'config.json'), 'w') as f:
+    json.dump(config, f, indent=2)
+  os.rename(tmp, entry)
+
+def extract_features_multi(extractors, type='all', batch_size=32, image_size=(512, 512), cache_dir=None, shards_dir=None,
+                           out_of_core=False, dtype=np.float32):
+  # out_of_core streams the features into memory-mapped .npy files in the cache (stored as
+  # dtype, e.g. np.float16) instead of RAM, and resumes an interrupted extraction
+  assert shards_dir is None or image_size is not None, 'Shards are stored at a fixed resolution: native-resolution extraction reads the tfds dataset'
+  dir = "/content/gdrive/MyDrive/dataset"
+  builder = tfds.builder("diabetic_retinopathy_detection/btgraham-300", data_dir=dir)
+  if type == 'all':
+    splits = ['train', 'test']
+  elif type == 'train':
+    splits = ['train']
+  else:
+    splits = ['test']
+
+  outputs = [[] for _ in extractors]
+  for split in splits:
+    split_outputs = [None] * len(extractors)
+    split_shards_dir = None if shards_dir is None else os.path.join(shards_dir, split)
+    entries = [feature_cache_entry(cache_dir, extractor, builder.info, split, image_size, split_shards_dir, dtype)
+               for extractor in extractors]
+    for k, cached in enumerate(entries):
+      if cached is not None and os.path.isdir(cached[0]):
+        split_outputs[k] = load_cached_features(cached[0])
+        print('Loaded %s features from %s'%(split, cached[0]))
+
+    # Extractors without a cache hit share one decode/resize pass
+    missing = [k for k, out in enumerate(split_outputs) if out is None]
+    if missing and out_of_core and all(entries[k] is not None for k in missing):
+      # Deterministic read order, so rows already on disk can be skipped on resume
+      if shards_dir is None:
+        n_samples = builder.info.splits[split].num_examples
+        make_ds = lambda offset: builder.as_dataset(split='%s[%d:]'%(split, offset), shuffle_files=False)
+      else:
+        ds = load_image_shards(os.path.join(shards_dir, split))
+        assert tuple(ds.element_spec[0].shape[:2]) == tuple(image_size), 'Shards were written at a different resolution'
+        n_samples = len(ds)
+        make_ds = lambda offset: load_image_shards(os.path.join(shards_dir, split)).skip(offset)
+      partials = [open_partial_features(entries[k][0], n_samples, extractors[k].output.shape[-1], dtype) for k in missing]
+      offset = min(done for _, _, done in partials)
+      if offset > 0:
+        print('Resuming %s extraction at %d/%d'%(split, offset, n_samples))
+
+      def on_progress(done):
+        # Labels are written through the first entry and copied into the others' files
+        for k, (feats, labs, _) in zip(missing, partials):
+          labs[:done] = partials[0][1][:done]
+          commit_partial_features(entries[k][0], feats, labs, done)
+
+      if offset < n_samples:
+        extract_split([extractors[k] for k in missing], make_ds(offset), 'Training' if split == 'train' else 'Validation',
+                      batch_size, image_size, outputs=([feats for feats, _, _ in partials], partials[0][1]), offset=offset,
+                      on_progress=on_progress)
+      for k, (feats, labs, _) in zip(missing, partials):
+        commit_partial_features(entries[k][0], feats, labs, n_samples, entries[k][1])
+        split_outputs[k] = load_cached_features(entries[k][0])
+    elif missing:
+      if out_of_core:
+        print('Out-of-core extraction needs cache_dir and a restored checkpoint: extracting in memory')
+      if shards_dir is None:
+        ds = builder.as_dataset(split=split, shuffle_files=True)
+      else:
+        ds = load_image_shards(os.path.join(shards_dir, split))
+        assert tuple(ds.element_spec[0].shape[:2]) == tuple(image_size), 'Shards were written at a different resolution'
+      features, labels = extract_split([extractors[k] for k in missing], ds,
+                                       'Training' if split == 'train' else 'Validation', batch_size, image_size)
+      for k, feats in zip(missing, features):
+        split_outputs[k] = (feats, labels)
+        if entries[k] is not None:
+          save_cached_features(entries[k][0], entries[k][1], feats, labels)
+
+    for out, (feats, labels) in zip(outputs, split_outputs):
+      out += [feats, labels]
+  return [tuple(out) for out in outputs]
+
+def extract_features(extractor, type='all', batch_size=32, image_size=(512, 512), cache_dir=None, shards_dir=None,
+                     out_of_core=False, dtype=np.float32):
+  return extract_features_multi([extractor], type, batch_size, image_size, cache_dir, shards_dir, out_of_core, dtype)[0]
+
+def compare_extraction_resolutions(discriminator, image_sizes=[(512, 512), (384, 384), (300, 300), None], batch_size=32):
+  # Extraction throughput and test MAE of the closed-form regressor for each
+  # input resolution, relative to the 512x512 baseline
+  results = []
+  for image_size in image_sizes:
+    extractor = create_extractor(discriminator, image_size=image_size)
+    start = time.time()
+    features, labels, test_feats, test_labs = extract_features(extractor, batch_size=batch_size, image_size=image_size)
+    throughput = (len(labels) + len(test_labs)) / (time.time() - start)
+    weights = make_weights(labels, 'class')
+    M = solve_weighted_least_squares(np.concatenate([features, np.ones((len(features), 1))], axis=-1), labels, weights)
+    predictions = np.concatenate([test_feats, np.ones((len(test_feats), 1))], axis=-1) @ M
+    results.append({'image_size': 'native' if image_size is None else '%dx%d'%tuple(image_size),
+                    'images_per_sec': throughput, 'mae': float(np.mean(np.abs(test_labs - predictions)))})
+
+  for result in results:
+    result['speedup'] = result['images_per_sec'] / results[0]['images_per_sec']
+    result['mae_change'] = result['mae'] - results[0]['mae']
+  return results
+
+def build_inference_extractor(extractor, image_size=(512, 512)):
+  # Same weights as create_extractor's model, with the Dropout layers (identity at inference) left out of the graph
+  input = tf.keras.layers.Input(shape=(image_size[0], image_size[1], 3))
+  x = input
+  for layer in extractor.layers[1].layers:
+    if not isinstance(layer, (tf.keras.layers.InputLayer, tf.keras.layers.Dropout)):
+      x = layer(x)
+  x = tf.keras.layers.GlobalAveragePooling2D()(x)
+  return tf.keras.models.Model(input, x)
+
+def calibration_images(n_images=200, image_size=(512, 512)):
+  dir = "/content/gdrive/MyDrive/dataset"
+  ds = tfds.load("diabetic_retinopathy_detection/btgraham-300", split='train', data_dir=dir, shuffle_files=True)
+  return ds.take(n_images).map(lambda sample: preprocess_sample(sample, image_size)[0], num_parallel_calls=tf.data.AUTOTUNE)
+
+def export_extractor(extractor, export_path, format='tflite', quantization=None, calibration_ds=None, image_size=(512, 512)):
+  model = build_inference_extractor(extractor, image_size)
+  if format == 'saved_model':
+    tf.saved_model.save(model, export_path)
+    return export_path
+
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  if quantization == 'float16':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+  elif quantization == 'int8':
+    # Activation ranges are calibrated on real fundus images; inputs and outputs stay float32
+    if calibration_ds is None:
+      calibration_ds = calibration_images(image_size=image_size)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([image[None]] for image in calibration_ds)
+  with open(export_path, 'wb') as f:
+    f.write(converter.convert())
+  return export_path
+
+def tflite_features(tflite_path, images, num_threads=None):
+  interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads or os.cpu_count())
+  interpreter.allocate_tensors()
+  input_index = interpreter.get_input_details()[0]['index']
+  output_index = interpreter.get_output_details()[0]['index']
+  features = []
+  for image in images:
+    interpreter.set_tensor(input_index, image[None].astype(np.float32))
+    interpreter.invoke()
+    features.append(interpreter.get_tensor(output_index)[0])
+  return np.stack(features)
+
+def check_exported_extractor(extractor, tflite_path, images, batch_size=32):
+  # Parity with the float32 Keras features and CPU throughput of both
+  images = np.asarray(images, dtype=np.float32)
+  start = time.time()
+  reference = np.concatenate([extractor(images[i:i + batch_size], training=False).numpy() for i in range(0, len(images), batch_size)])
+  keras_time = time.time() - start
+  start = time.time()
+  exported = tflite_features(tflite_path, images)
+  tflite_time = time.time() - start
+
+  cosine = np.sum(reference * exported, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(exported, axis=1))
+  return {
+      'max_abs_diff': float(np.max(np.abs(reference - exported))),
+      'mean_rel_diff': float(np.mean(np.abs(reference - exported)) / np.mean(np.abs(reference))),
+      'min_cosine': float(np.min(cosine)),
+      'keras_images_per_sec': len(images) / keras_time,
+      'tflite_images_per_sec': len(images) / tflite_time,
+      'size_mb': os.path.getsize(tflite_path) / 2**20,
+  }
+
+def solve_weighted_least_squares(samples, labels, weights, ridge=0.0, method='cholesky'):
+  # Minimizes sum(w * (y - samples @ M)^2) + ridge * |M|^2 through the weighted
+  # normal equations; the last (bias) column of samples is not regularized
+  samples = np.asarray(samples, dtype=np.float64)
+  labels = np.asarray(labels, dtype=np.float64)
+  sample_weights = np.asarray(weights, dtype=np.float64)[labels.astype(int)]
+  penalty = np.full(samples.shape[1], ridge, dtype=np.float64)
+  penalty[-1] = 0
+
+  if method == 'cholesky':
+    gram = samples.T @ (samples * sample_weights[:, None]) + np.diag(penalty)
+    moment = samples.T @ (sample_weights * labels)
+    try:
+      return scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram), moment)
+    except np.linalg.LinAlgError:
+      # Rank-deficient features without a ridge term
+      return np.linalg.lstsq(gram, moment, rcond=None)[0]
+  elif method == 'qr':
+    sqrt_weights = np.sqrt(sample_weights)
+    a = np.vstack([samples * sqrt_weights[:, None], np.diag(np.sqrt(penalty))])
+    b = np.concatenate([labels * sqrt_weights, np.zeros(len(penalty))])
+    q, r = np.linalg.qr(a)
+    return scipy.linalg.solve_triangular(r, q.T @ b)
+  else:
+    raise ValueError("Unknown method %r: expected 'cholesky' or 'qr'"%(method,))
+
+def class_gram_stats(features, labels, index=None, chunk_size=4096):
+  # Per-class sufficient statistics of the bias-augmented features: any
+  # class-weighted least squares system is a weighted sum of these
+  labels = np.asarray(labels)
+  if index is None:
+    index = np.arange(len(labels))
+  d = features.shape[-1] + 1
+  stats = {
+      'gram': np.zeros((5, d, d)),
+      'moment': np.zeros((5, d)),
+      'label_sq': np.zeros(5),
+      'counts': np.zeros(5),
+  }
+  for i in range(0, len(index), chunk_size):
+    chunk = index[i:i + chunk_size]
+    samples = np.concatenate([np.asarray(features[chunk], dtype=np.float64), np.ones((len(chunk), 1))], axis=-1)
+    labs = labels[chunk].astype(np.float64)
+    classes = labs.astype(int)
+    for c in np.unique(classes):
+      mask = classes == c
+      stats['gram'][c] += samples[mask].T @ samples[mask]
+      stats['moment'][c] += samples[mask].T @ labs[mask]
+      stats['label_sq'][c] += labs[mask] @ labs[mask]
+      stats['counts'][c] += mask.sum()
+  return stats
+
+def solve_class_gram_stats(stats, class_weights, ridge=0.0):
+  # The weighted normal equations of solve_weighted_least_squares, assembled from class_gram_stats
+  penalty = np.full(stats['gram'].shape[-1], ridge)
+  penalty[-1] = 0
+  gram = np.einsum('c,cij->ij', class_weights, stats['gram']) + np.diag(penalty)
+  moment = class_weights @ stats['moment']
+  try:
+    return scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram), moment)
+  except np.linalg.LinAlgError:
+    return np.linalg.lstsq(gram, moment, rcond=None)[0]
+
+class Regressor(tf.keras.Model):
+    def __init__(self, parameters):
+        super(Regressor, self).__init__()
+        self.parameters = parameters
+        self.M = tf.Variable(tf.zeros([self.parameters]), dtype = tf.float32, trainable=True)
+        self.best_M = tf.Variable(tf.zeros([self.parameters]), dtype = tf.float32, trainable=False)
+        # Wrapped per instance rather than decorated, so the class itself stays
+        # picklable for the cross-validation workers
+        self._compiled_fit_loop = tf.function(self._fit_loop)
+        self._compiled_fit_stats_loop = tf.function(self._fit_stats_loop)
+
+    def call(self, val_feats):
+        return tf.tensordot(val_feats, self.M, axes=1)
+
+    def fit_analytical(self, train_samples, train_labs, weights, ridge=0.0, method='cholesky'):
+        self.M.assign(solve_weighted_least_squares(train_samples, train_labs, weights, ridge, method).astype(np.float32))
+
+    def fit_stats(self, stats, weights, ridge=0.0):
+        # Same solution as fit_analytical with method='cholesky', from statistics accumulated
+        # chunk by chunk: memory-mapped features are never loaded whole
+        self.M.assign(solve_class_gram_stats(stats, np.asarray(weights, dtype=np.float64), ridge).astype(np.float32))
+
+    def compile(self, optimizer):
+        super(Regressor, self).compile()
+        self.optimizer = optimizer
+
+    def fit(self, train_samples, train_labs, weights, epochs, val_samples=None, val_labs=None, val_every=1, patience=None):
+        # Without a validation set, early stopping and the best snapshot track the training loss
+        if val_samples is None or val_labs is None:
+          val_samples, val_labs = train_samples, train_labs
+        weights = tf.constant(weights, dtype=tf.float32)
+        train_labs = tf.cast(train_labs, tf.float32)
+        val_labs = tf.cast(val_labs, tf.float32)
+
+        train_losses, val_losses, best_loss = self._compiled_fit_loop(
+            tf.cast(train_samples, tf.float32), train_labs, tf.gather(weights, tf.cast(train_labs, tf.int32)),
+            tf.cast(val_samples, tf.float32), val_labs, tf.gather(weights, tf.cast(val_labs, tf.int32)),
+            tf.constant(epochs), tf.constant(val_every), tf.constant(epochs if patience is None else patience))
+        self.M.assign(self.best_M)
+        return train_losses.numpy(), val_losses.numpy(), best_loss.numpy()
+
+    def fit_gradient_stats(self, train_stats, weights, epochs, val_stats=None, val_every=1, patience=None):
+        # Same losses and early stopping as fit, from class_gram_stats: the weighted squared
+        # error is M.A.M - 2 b.M + c, with A, b and c the class-weighted gram, moment and
+        # label_sq, so an epoch costs O(d^2) and memory-mapped features are never loaded whole
+        if val_stats is None:
+          val_stats = train_stats
+        weights = np.asarray(weights, dtype=np.float64)
+
+        def quadratic(stats, norm):
+          return [tf.constant(x / norm, dtype=tf.float32) for x in
+                  (np.einsum('c,cij->ij', weights, stats['gram']), weights @ stats['moment'], weights @ stats['label_sq'])]
+
+        train_losses, val_losses, best_loss = self._compiled_fit_stats_loop(
+            *quadratic(train_stats, train_stats['counts'].sum()),
+            *quadratic(val_stats, weights @ val_stats['counts']),
+            tf.constant(epochs), tf.constant(val_every), tf.constant(epochs if patience is None else patience))
+        self.M.assign(self.best_M)
+        return train_losses.numpy(), val_losses.numpy(), best_loss.numpy()
+
+    def _fit_loop(self, train_samples, train_labs, train_weights, val_samples, val_labs, val_weights, epochs, val_every, patience):
+        train_loss = lambda: tf.reduce_mean(train_weights * tf.square(train_labs - tf.tensordot(train_samples, self.M, axes=1)))
+        val_loss = lambda: tf.reduce_sum(val_weights * tf.square(val_labs - tf.tensordot(val_samples, self.M, axes=1))) / tf.reduce_sum(val_weights)
+        return self._descent(train_loss, val_loss, epochs, val_every, patience)
+
+    def _fit_stats_loop(self, train_gram, train_moment, train_label_sq, val_gram, val_moment, val_label_sq, epochs, val_every, patience):
+        quadratic = lambda gram, moment, label_sq: tf.tensordot(self.M, tf.linalg.matvec(gram, self.M) - 2 * moment, axes=1) + label_sq
+        train_loss = lambda: quadratic(train_gram, train_moment, train_label_sq)
+        val_loss = lambda: quadratic(val_gram, val_moment, val_label_sq)
+        return self._descent(train_loss, val_loss, epochs, val_every, patience)
+
+    def _descent(self, train_loss, val_loss_fn, epochs, val_every, patience):
+        train_losses = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        val_losses = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        best_loss = tf.constant(np.inf, dtype=tf.float32)
+        wait = tf.constant(0)
+        for epoch in tf.range(epochs):
+          with tf.GradientTape() as tape:
+            loss = train_loss()
+          grads = tape.gradient(loss, self.trainable_variables)
+          self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+          train_losses = train_losses.write(train_losses.size(), loss)
+
+          if (epoch + 1) % val_every == 0 or epoch + 1 == epochs:
+            val_loss = val_loss_fn()
+            val_losses = val_losses.write(val_losses.size(), val_loss)
+            if val_loss < best_loss:
+              best_loss = val_loss
+              self.best_M.assign(self.M)
+              wait = tf.zeros_like(wait)
+            else:
+              wait += val_every
+            if wait >= patience:
+              break
+        return train_losses.stack(), val_losses.stack(), best_loss
+
+def make_weights(labels, type):
+  weights = None
+  labels_count = np.bincount(np.asarray(labels).astype(int), minlength=5)
+  class_weights = (len(labels) / (labels_count * 5)).astype(np.float32)
+  if type == 'class':
+    weights = class_weights.astype(np.float64)
+  elif type == 'sample':
+    weights = class_weights[np.asarray(labels).astype(int)]
+  else:
+    print('Method not found')
+  return weights
+
+class OnlineRegressor:
+    # Keeps the per-class statistics of class_gram_stats instead of the samples: a batch
+    # is absorbed in O(batch * d^2) and a refit costs O(d^3), whatever the samples seen so far
+    def __init__(self, n_features, ridge=0.0):
+        d = n_features + 1
+        self.ridge = ridge
+        self.stats = {
+            'gram': np.zeros((5, d, d)),
+            'moment': np.zeros((5, d)),
+            'label_sq': np.zeros(5),
+            'counts': np.zeros(5),
+        }
+        self.M = np.zeros(d)
+
+    def partial_fit(self, features, labels, refit=True):
+        batch = class_gram_stats(features, labels)
+        for key in self.stats:
+          self.stats[key] += batch[key]
+        if refit:
+          self.refit()
+        return self
+
+    def class_weights(self):
+        # make_weights(labels, 'class') from the running counts; unseen classes get no weight
+        counts = self.stats['counts']
+        weights = np.zeros(5)
+        weights[counts > 0] = (counts.sum() / (counts[counts > 0] * 5)).astype(np.float32)
+        return weights
+
+    def refit(self):
+        self.M = solve_class_gram_stats(self.stats, self.class_weights(), self.ridge)
+        return self
+
+    def loss(self):
+        # Class-weighted training MSE, expanded from the statistics
+        weights = self.class_weights()
+        squared_error = np.einsum('i,cij,j->c', self.M, self.stats['gram'], self.M) - 2 * self.stats['moment'] @ self.M + self.stats['label_sq']
+        return (weights * squared_error).sum() / (weights * self.stats['counts']).sum()
+
+    def predict(self, features):
+        return np.asarray(features, dtype=np.float64) @ self.M[:-1] + self.M[-1]
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+          np.savez(f, ridge=self.ridge, M=self.M, **self.stats)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+          regressor = cls(state['M'].shape[0] - 1, float(state['ridge']))
+          regressor.M = state['M']
+          regressor.stats = {key: state[key] for key in regressor.stats}
+        return regressor
+
+def latency_percentiles(latencies):
+  latencies = np.asarray(latencies) * 1000
+  if len(latencies) == 0:
+    return {}
+  return {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+          'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}
+
+class MicroBatcher:
+    # Coalesces concurrent requests: a batch is run as soon as it holds max_batch_size
+    # images or max_wait_ms have passed since its first image arrived
+    def __init__(self, score_fn, max_batch_size=32, max_wait_ms=10, history=10000):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image):
+        future = concurrent.futures.Future()
+        self.requests.put((image, future, time.time()))
+        return future
+
+    def reset_stats(self):
+        with self.lock:
+          self.latencies.clear()
+          self.batch_sizes.clear()
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+          request = self.requests.get()
+          if request is None:
+            return
+          batch = [request]
+          deadline = time.time() + self.max_wait
+          while len(batch) < self.max_batch_size:
+            try:
+              request = self.requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+              break
+            if request is None:
+              self.requests.put(None)
+              break
+            batch.append(request)
+
+          try:
+            scores = self.score_fn([image for image, _, _ in batch])
+          except Exception as e:
+            for _, future, _ in batch:
+              future.set_exception(e)
+            continue
+          done = time.time()
+          with self.lock:
+            self.latencies.extend(done - start for _, _, start in batch)
+            self.batch_sizes.append(len(batch))
+          for (_, future, _), score in zip(batch, scores):
+            future.set_result(float(score))
+
+    def stats(self):
+        with self.lock:
+          latencies = list(self.latencies)
+          batch_sizes = list(self.batch_sizes)
+        return {'queue_depth': self.requests.qsize(), 'requests': len(latencies), 'batches': len(batch_sizes),
+                'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                'latency_ms': latency_percentiles(latencies)}
+
+def make_scoring_handler(scorer, batcher):
+  class ScoringHandler(http.server.BaseHTTPRequestHandler):
+      # POST /score with the image file as the body, GET /stats
+      def do_POST(self):
+        if self.path != '/score':
+          return self.send_error(404)
+        image = scorer.preprocess(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if image is None:
+          return self.send_error(400, 'Not a fundus image')
+        self.send_json({'score': batcher.submit(image).result()})
+
+      def do_GET(self):
+        if self.path != '/stats':
+          return self.send_error(404)
+        self.send_json(batcher.stats())
+
+      def send_json(self, content):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+  return ScoringHandler
+
+def serve_scorer(scorer, port=8000, max_batch_size=32, max_wait_ms=10):
+  # Runs in a background thread; stop with server.shutdown() and server.batcher.close()
+  batcher = MicroBatcher(scorer.score, max_batch_size, max_wait_ms)
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', port), make_scoring_handler(scorer, batcher))
+  server.batcher = batcher
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def load_test(url, image_paths, n_requests=1000, concurrency=32):
+  payloads = []
+  for path in image_paths:
+    with open(path, 'rb') as f:
+      payloads.append(f.read())
+
+  def send(i):
+    start = time.time()
+    request = urllib.request.Request(url + '/score', data=payloads[i % len(payloads)],
+                                     headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+      json.load(response)
+    return time.time() - start
+
+  start = time.time()
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+    latencies = list(pool.map(send, range(n_requests)))
+  elapsed = time.time() - start
+  with urllib.request.urlopen(url + '/stats') as response:
+    server_stats = json.load(response)
+  return {'requests_per_sec': n_requests / elapsed, 'latency_ms': latency_percentiles(latencies), 'server': server_stats}
+
+def synthetic_image_dataset(n_images, image_size=(512, 512), seed=0):
+  # Same element structure as the tfds splits, generated on the fly
+  def sample(i):
+    image = tf.random.stateless_uniform([image_size[0], image_size[1], 3], seed=[seed, i], maxval=256, dtype=tf.int32)
+    label = tf.random.stateless_uniform([], seed=[seed + 1, i], maxval=5, dtype=tf.int64)
+    return {'image': tf.cast(image, tf.uint8), 'label': label}
+  return tf.data.Dataset.range(n_images).map(sample, num_parallel_calls=tf.data.AUTOTUNE)
+
+def synthetic_features(n_samples, n_features=512, seed=0):
+  # Labels follow the class imbalance of the train split
+  rng = np.random.default_rng(seed)
+  labels = rng.choice(5, size=n_samples, p=[0.73, 0.07, 0.15, 0.03, 0.02]).astype(np.float32)
+  features = rng.standard_normal((n_samples, n_features), dtype=np.float32) + labels[:, None] * 0.1
+  return features, labels
+
+def time_call(fn, repeats=5, warmup=1):
+  for _ in range(warmup):
+    fn()
+  times = []
+  for _ in range(repeats):
+    start = time.time()
+    fn()
+    times.append(time.time() - start)
+  return {'median': float(np.median(times)), 'min': float(np.min(times)), 'repeats': repeats}
+
+def fit_keras_dense(train_feats, train_labs, epochs, val_feats, val_labs):
+  # Linear regression as a single Dense unit, trained full-batch with class weights
+  weights = make_weights(train_labs, 'class')
+  c_w = {0: weights[0], 1: weights[1], 2: weights[2], 3: weights[3], 4: weights[4]}
+  val_weights = np.zeros(len(val_labs))
+  for i, lab in enumerate(val_labs):
+    val_weights[i] = weights[int(lab)]
+  input = tf.keras.layers.Input(shape=train_feats.shape[-1])
+  output = tf.keras.layers.Dense(units=1)(input)
+  regressor = tf.keras.models.Model(input, output)
+  regressor.compile(optimizer=tf.optimizers.Adam(learning_rate=0.1), loss='mse')
+  for i in range(0, epochs):
+    train_loss = regressor.train_on_batch(train_feats, train_labs, class_weight=c_w)
+    val_loss = mean_squared_error(val_labs, regressor(val_feats), sample_weight=val_weights)
+    print('\r\t\tEpoch: %d || train_loss: %f - val_loss: %f'%(i+1, train_loss, val_loss), end='')
+  return val_loss
+
+def fit_linear_backend(model_name, train_feats, train_labs, epochs, val_feats, val_labs, solver='closed_form', ridge=0.0,
+                       val_every=1, patience=None):
+  # The train_and_evaluate_model backends without the notebook's globals; returns the class-weighted validation MSE
+  weights = make_weights(train_labs, 'class')
+  val_weights = np.asarray(weights)[np.asarray(val_labs).astype(int)]
+  if model_name == "LR_Analytical_Optimization":
+    regressor = Regressor(parameters = train_feats.shape[-1] + 1)
+    if solver == 'closed_form':
+      regressor.fit_stats(class_gram_stats(train_feats, train_labs), weights, ridge)
+    else:
+      regressor.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.1))
+      regressor.fit_gradient_stats(class_gram_stats(train_feats, train_labs), weights, epochs,
+                                   class_gram_stats(val_feats, val_labs), val_every, patience)
+    val_samples = np.concatenate([np.asarray(val_feats, dtype=np.float32), np.ones((len(val_feats), 1), dtype=np.float32)], axis=-1)
+    return mean_squared_error(val_labs, regressor(val_samples), sample_weight=val_weights)
+  elif model_name == "LR_SKlearn":
+    reg = LinearRegression()
+    # sklearn makes an in-memory float64 copy of the features
+    reg.fit(train_feats, train_labs, sample_weight=make_weights(train_labs, 'sample'))
+    return mean_squared_error(val_labs, reg.predict(val_feats), sample_weight=val_weights)
+  elif model_name == "LR_Keras_Dense_Layer":
+    return fit_keras_dense(train_feats, train_labs, epochs, val_feats, val_labs)
+  raise ValueError("Unknown model %r"%(model_name,))
+
+DEFAULT_BACKENDS = {
+    'closed_form': (fit_linear_backend, "LR_Analytical_Optimization", {'solver': 'closed_form'}),
+    'gradient': (fit_linear_backend, "LR_Analytical_Optimization", {'solver': 'gradient'}),
+    'sklearn': (fit_linear_backend, "LR_SKlearn", {}),
+    'keras_dense': (fit_linear_backend, "LR_Keras_Dense_Layer", {}),
+}
+
+def run_benchmarks(out_path=None, backends=None, n_images=256, batch_size=32, n_samples=35000, n_features=512,
+                   epochs=1000, gan_batch_size=4, gan_steps=5, repeats=5):
+  # Offline: synthetic images and features, freshly initialized weights, no dataset or Drive access.
+  # backends: name -> (train function, model_name, keyword arguments), DEFAULT_BACKENDS by default
+  if out_path is None:
+    out_path = os.path.join('benchmarks', 'benchmark-%s.json'%(time.strftime('%Y%m%d-%H%M%S')))
+  if backends is None:
+    backends = DEFAULT_BACKENDS
+  results = {}
+
+  extractor = create_extractor(build_discriminator())
+  extract_split([extractor], synthetic_image_dataset(batch_size), 'warmup', batch_size)
+  timing = time_call(lambda: extract_split([extractor], synthetic_image_dataset(n_images), 'synthetic', batch_size), repeats, warmup=0)
+  results['extract_features'] = dict(timing, images_per_sec=n_images / timing['median'], n_images=n_images, batch_size=batch_size)
+
+  for ver in [1, 2]:
+    for result in benchmark_generators(ver, gan_batch_size, gan_steps):
+      results['train_step/ver%d/%s'%(ver, result['generator_arch'])] = dict(result, batch_size=gan_batch_size)
+
+  features, labels = synthetic_features(n_samples, n_features)
+  val_features, val_labels = synthetic_features(n_samples // 5, n_features, seed=1)
+  for name, (train_fn, model_name, kwargs) in backends.items():
+    timing = time_call(lambda: train_fn(model_name, features, labels, epochs, val_features, val_labels, **kwargs), repeats)
+    results['train_and_evaluate_model/%s'%(name)] = dict(timing, n_samples=n_samples, n_features=n_features, epochs=epochs)
+    print()
+
+  for type in ['class', 'sample']:
+    results['make_weights/%s'%(type)] = dict(time_call(lambda: make_weights(labels, type), repeats), n_samples=n_samples)
+
+  report = {
+      'commit': subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None,
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'tensorflow': tf.__version__,
+      'devices': [device.name for device in tf.config.list_physical_devices()],
+      'cpu_count': os.cpu_count(),
+      'results': results,
+  }
+  os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+  with open(out_path, 'w') as f:
+    json.dump(report, f, indent=2)
+  return report
+
+def score_grades(predictions):
+  # Continuous severity scores rounded to the 0-4 retinopathy grades
+  return np.clip(np.rint(predictions), 0, 4).astype(np.int64)
+
+def batched_metrics(labels, predictions, class_weights, index):
+  # Metrics of every row of index (n_resamples x n_samples) at once
+  labels = labels.astype(np.int64)
+  errors = predictions - labels
+  sample_weights = class_weights[labels]
+  codes = (labels * 5 + score_grades(predictions))[index] + 25 * np.arange(len(index))[:, None]
+  confusion = np.bincount(codes.ravel(), minlength=25 * len(index)).reshape(len(index), 5, 5).astype(np.float64)
+
+  # Quadratic weighted kappa: observed vs chance agreement of the confusion matrices
+  grade_distance = (np.arange(5)[:, None] - np.arange(5)[None, :]) ** 2 / 16
+  expected = np.einsum('ri,rj->rij', confusion.sum(2), confusion.sum(1)) / confusion.sum((1, 2))[:, None, None]
+  return {
+      'mae': np.abs(errors)[index].mean(1),
+      'weighted_mse': (sample_weights * errors ** 2)[index].sum(1) / sample_weights[index].sum(1),
+      'qwk': 1 - np.einsum('ij,rij->r', grade_distance, confusion) / np.einsum('ij,rij->r', grade_distance, expected),
+  }
+
+def bootstrap_chunk(labels, predictions, class_weights, n_resamples, seed):
+  # The models share the resamples, so their differences are paired
+  index = np.random.default_rng(seed).integers(0, len(labels), size=(n_resamples, len(labels)), dtype=np.int32)
+  return {name: batched_metrics(labels, preds, class_weights, index) for name, preds in predictions.items()}
+
+def evaluation_report(labels, predictions, class_weights=None, n_resamples=5000, chunk_size=100, confidence=0.95,
+                      n_jobs=-1, seed=0):
+  # predictions: model name -> scores; class_weights default to make_weights on the evaluated labels
+  labels = np.asarray(labels)
+  predictions = {name: np.asarray(preds, dtype=np.float64).reshape(-1) for name, preds in predictions.items()}
+  if class_weights is None:
+    class_weights = make_weights(labels, 'class')
+  class_weights = np.asarray(class_weights, dtype=np.float64)
+
+  full_index = np.arange(len(labels))[None]
+  point = {name: {metric: float(value[0]) for metric, value in batched_metrics(labels, preds, class_weights, full_index).items()}
+           for name, preds in predictions.items()}
+
+  start = time.time()
+  chunks = [min(chunk_size, n_resamples - i) for i in range(0, n_resamples, chunk_size)]
+  seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+  results = joblib.Parallel(n_jobs=n_jobs, backend='loky')(
+      joblib.delayed(bootstrap_chunk)(labels, predictions, class_weights, n, s) for n, s in zip(chunks, seeds))
+  samples = {name: {metric: np.concatenate([r[name][metric] for r in results]) for metric in point[name]} for name in predictions}
+
+  alpha = (1 - confidence) / 2
+  report = {'n_resamples': n_resamples, 'confidence': confidence, 'models': {}, 'differences': {}}
+  print('%-14s %-28s %10s   %d%% CI'%('metric', 'model', 'value', confidence * 100))
+  for metric in ['mae', 'weighted_mse', 'qwk']:
+    for name in predictions:
+      low, high = np.quantile(samples[name][metric], [alpha, 1 - alpha])
+      report['models'].setdefault(name, {})[metric] = {'value': point[name][metric], 'low': float(low), 'high': float(high)}
+      print('%-14s %-28s %10.4f   [%.4f, %.4f]'%(metric, name, point[name][metric], low, high))
+    names = list(predictions)
+    for a, b in zip(names[:-1], names[1:]):
+      difference = samples[b][metric] - samples[a][metric]
+      low, high = np.quantile(difference, [alpha, 1 - alpha])
+      key = '%s - %s'%(b, a)
+      report['differences'].setdefault(key, {})[metric] = {'value': point[b][metric] - point[a][metric], 'low': float(low), 'high': float(high)}
+      print('%-14s %-28s %+10.4f   [%+.4f, %+.4f]'%(metric, key, point[b][metric] - point[a][metric], low, high))
+
+  for name, preds in predictions.items():
+    confusion = np.bincount(labels.astype(np.int64) * 5 + score_grades(preds), minlength=25).reshape(5, 5)
+    report['models'][name]['confusion_matrix'] = confusion.tolist()
+    print('\n%s confusion matrix (rows: label, columns: rounded score)\n%s'%(name, confusion))
+  print('\n%d resamples in %.2fs'%(n_resamples, time.time() - start))
+  return report
+
+def compare_benchmarks(baseline_path, current_path):
+  # Ratio of the current to the baseline time of every benchmark the two runs share
+  with open(baseline_path) as f:
+    baseline = json.load(f)['results']
+  with open(current_path) as f:
+    current = json.load(f)['results']
+  ratios = {}
+  for name in sorted(set(baseline) & set(current)):
+    key = 'median' if 'median' in current[name] else 'step_time'
+    ratios[name] = current[name][key] / baseline[name][key]
+    print('%-50s %8.4fs -> %8.4fs  x%.2f'%(name, baseline[name][key], current[name][key], ratios[name]))
+  return ratios
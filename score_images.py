@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Batch scoring of fundus images
+
+Restores only the discriminator of a trained GAN, extracts features from raw
+fundus images and scores them with a saved regressor. Usable from the notebook
+or as
+
+    python score_images.py IMAGE_DIR OUTPUT_CSV --regressor REGRESSOR [--checkpoint-dir DIR]
+"""
+
+import os
+import csv
+import time
+import argparse
+import collections
+import concurrent.futures
+
+import numpy as np
+import cv2
+import joblib
+import tensorflow as tf
+
+from build_dataset import btgraham_preprocess
+from retinopathy_gan import Regressor, OnlineRegressor, create_extractor, preprocess_sample, restore_discriminator
+
+class Scorer:
+    # Raw fundus image bytes -> severity score, with a fitted LinearRegression or Regressor on top of the extractor
+    def __init__(self, extractor, regressor, image_size=(512, 512), btgraham=True):
+        self.regressor = regressor
+        self.image_size = image_size
+        self.btgraham = btgraham
+        self.features = tf.function(lambda images: extractor(images, training=False),
+                                    input_signature=[tf.TensorSpec([None, image_size[0], image_size[1], 3], tf.float32)])
+
+    def preprocess(self, data):
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+          return None
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if self.btgraham:
+          image = btgraham_preprocess(image)
+        return preprocess_sample({'image': image, 'label': 0}, self.image_size)[0].numpy()
+
+    def score(self, images):
+        feats = self.features(np.stack(images)).numpy()
+        if isinstance(self.regressor, Regressor):
+          return self.regressor(np.concatenate([feats, np.ones((len(feats), 1), dtype=np.float32)], axis=-1)).numpy()
+        return self.regressor.predict(feats)
+
+def save_regressor(regressor, path):
+  # Regressor weights as .npy, OnlineRegressor state as .npz, anything else (LinearRegression) through joblib
+  if isinstance(regressor, Regressor):
+    np.save(path, regressor.M.numpy())
+  elif isinstance(regressor, OnlineRegressor):
+    regressor.save(path)
+  else:
+    joblib.dump(regressor, path)
+
+def load_regressor(path):
+  if path.endswith('.npy'):
+    M = np.load(path)
+    regressor = Regressor(parameters=len(M))
+    regressor.M.assign(M)
+    return regressor
+  if path.endswith('.npz'):
+    return OnlineRegressor.load(path)
+  return joblib.load(path)
+
+def scored_image_ids(out_csv):
+  # Drops a row cut short by an interrupted run, so appending resumes cleanly
+  if not os.path.exists(out_csv):
+    return set()
+  with open(out_csv, 'rb+') as f:
+    data = f.read()
+    end = data.rfind(b'\n') + 1
+    f.truncate(end)
+  return set(line.split(',')[0] for line in data[:end].decode().splitlines()[1:])
+
+def score_directory(scorer, image_dir, out_csv, batch_size=64, num_workers=None, extensions=('.jpeg', '.jpg', '.png')):
+  # Streams image_id,score rows: the directory is walked lazily and at most
+  # 2 * batch_size decoded images are held at a time
+  done = scored_image_ids(out_csv)
+
+  def image_paths():
+    with os.scandir(image_dir) as entries:
+      for entry in entries:
+        image_id, ext = os.path.splitext(entry.name)
+        if ext.lower() in extensions and image_id not in done:
+          yield image_id, entry.path
+
+  def load(path):
+    with open(path, 'rb') as f:
+      return scorer.preprocess(f.read())
+
+  n_scored, n_failed = 0, 0
+  start = time.time()
+  with open(out_csv, 'a', newline='') as out, concurrent.futures.ThreadPoolExecutor(num_workers or os.cpu_count()) as pool:
+    writer = csv.writer(out)
+    if out.tell() == 0:
+      writer.writerow(['image_id', 'score'])
+    pending = collections.deque()
+    batch_ids, batch_images = [], []
+    paths = image_paths()
+    while True:
+      for image_id, path in paths:
+        pending.append((image_id, pool.submit(load, path)))
+        if len(pending) >= 2 * batch_size:
+          break
+      if not pending:
+        break
+      image_id, image = pending.popleft()
+      image = image.result()
+      if image is None:
+        # Unreadable or not a fundus image: recorded without a score so a resumed run skips it
+        writer.writerow([image_id, ''])
+        n_failed += 1
+      else:
+        batch_ids.append(image_id)
+        batch_images.append(image)
+      if len(batch_ids) == batch_size or (not pending and batch_ids):
+        writer.writerows(zip(batch_ids, ['%.6f'%score for score in scorer.score(batch_images)]))
+        out.flush()
+        n_scored += len(batch_ids)
+        batch_ids, batch_images = [], []
+        print('\rScored images: %d (%.1f images/sec)'%(n_scored, n_scored / (time.time() - start)), end='')
+  print('\nScored: %d  Failed: %d  Already scored: %d'%(n_scored, n_failed, len(done)))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Score a directory of fundus images into an image_id,score CSV')
+  parser.add_argument('image_dir')
+  parser.add_argument('output')
+  parser.add_argument('--regressor', required=True, help='saved with save_regressor')
+  parser.add_argument('--gan-version', type=int, default=2)
+  parser.add_argument('--checkpoint-dir', default=None, help='GAN checkpoints, instead of the Drive path of --gan-version')
+  parser.add_argument('--batch-size', type=int, default=64)
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--no-btgraham', action='store_true', help='images are already btgraham-300 preprocessed')
+  args = parser.parse_args(argv)
+
+  discriminator = restore_discriminator(args.gan_version, args.checkpoint_dir)
+  scorer = Scorer(create_extractor(discriminator), load_regressor(args.regressor), btgraham=not args.no_btgraham)
+  score_directory(scorer, args.image_dir, args.output, args.batch_size, args.workers)
+
+if __name__ == '__main__':
+  main()